@@ -9,6 +9,12 @@ class Argument:
 def transfer():
     parser = ArgumentParser()
     parser.add_argument('-m', '--mjd', action='store', dest='mjd', type=int, metavar='MJD', help='Transfer this MJD')
+    parser.add_argument('-l', '--mjdlist', nargs='+', type=int, dest='mjdlist', metavar='MJD', help='Backfill these MJDs, unless their status is already complete')
+    parser.add_argument('-s', '--since', action='store', dest='since', type=int, metavar='MJD', help='Backfill MJDs since this MJD that have incomplete or failed stages, or no status yet')
+    parser.add_argument('-w', '--workers', action='store', dest='workers', type=int, metavar='WORKERS', help='Backfill this many MJDs at once')
+    parser.add_argument('-W', '--watch', action='store', dest='watch', type=float, metavar='HOURS', help='Watch for settled files and download them incrementally for this many hours, then run the stages')
+    parser.add_argument('-P', '--plan', action='store_true', dest='plan', help='Estimate files, bytes and durations per section and stage without transferring')
+    parser.add_argument('-r', '--restart', action='store_true', dest='restart', help='Ignore the checkpoint journal and redo every unit of work')
     parser.add_argument('-I', '--ini_mode', action='store', dest='ini_mode', metavar='INI_MODE', help='ini mode', choices=['mos','lvm'])
     parser.add_argument('-L', '--log_dir', action='store', dest='log_dir', metavar='LOG_DIR', help='ini mode')
     section = parser.add_mutually_exclusive_group()
@@ -34,6 +40,47 @@ def transfer():
         args.mirror = True
     return parser.prog, args
 
+def transfer_trace():
+    parser = ArgumentParser()
+    parser.add_argument('-O', '--observatory', action='store', dest='observatory', metavar='OBSERVATORY', help='observatory', choices = ['apo','lco'])
+    parser.add_argument('-I', '--ini_mode', action='store', dest='ini_mode', metavar='INI_MODE', help='ini mode', choices=['mos','lvm'])
+    parser.add_argument('-m', '--mjd', nargs='+', type=int, dest='mjd', metavar='MJD', help="Rank these MJDs, or the range 'start end' with --range")
+    parser.add_argument('-r', '--range', action='store_true', dest='range', help='Treat --mjd start end as an inclusive range')
+    parser.add_argument('-g', '--group', action='store', dest='group', metavar='GROUP', help='Rank by group', choices=['command','program','mjd'], default='command')
+    parser.add_argument('-n', '--top', action='store', dest='top', type=int, metavar='TOP', help='Show the top N', default=20)
+    parser.add_argument('path', nargs='*', metavar='PATH', help='Trace files or directories (default: log dir of the observatory and mode)')
+    parser.add_argument('-v', '--verbose', action='store_true', dest='verbose', help='Set verbose')
+    args = parser.parse_args()
+    return parser.prog, args
+
+def verify_mjds():
+    parser = ArgumentParser()
+    location = parser.add_mutually_exclusive_group(required=True)
+    location.add_argument('-e', '--env', action='store', dest='env', metavar='ENV', help='Verify MJD directories under this env var, e.g. LVM_DATA_S')
+    location.add_argument('-d', '--dir', action='store', dest='dir', metavar='DIR', help='Verify MJD directories under this directory')
+    parser.add_argument('-m', '--mjd', nargs='+', type=int, dest='mjd', metavar='MJD', help="Verify these MJDs, or the range 'start end' with --range (default: all)")
+    parser.add_argument('-r', '--range', action='store_true', dest='range', help='Treat --mjd start end as an inclusive range')
+    parser.add_argument('-o', '--outdir', action='store', dest='outdir', metavar='OUTDIR', help='Write <mjd>.<method>.o/.e files here (default: current directory)')
+    parser.add_argument('-M', '--method', action='store', dest='method', metavar='METHOD', help='Sumfile method', default='md5sum')
+    parser.add_argument('-F', '--fast', action='store_true', dest='fast', help='Prefer a fast manifest next to the sumfile when one is usable')
+    parser.add_argument('-w', '--workers', action='store', dest='workers', type=int, metavar='WORKERS', help='Verify this many MJDs at once', default=4)
+    parser.add_argument('-t', '--threads', action='store', dest='threads', type=int, metavar='THREADS', help='Hash this many files at once per MJD')
+    parser.add_argument('-j', '--json', action='store', dest='json', metavar='FILE', help='Write the consolidated report here (default: OUTDIR/verify.<first>-<last>.json)')
+    parser.add_argument('-f', '--force', action='store_true', dest='force', help='Overwrite existing .o files')
+    parser.add_argument('-v', '--verbose', action='store_true', dest='verbose', help='Set verbose')
+    args = parser.parse_args()
+    return parser.prog, args
+
+def compare_mirror():
+    parser = ArgumentParser()
+    parser.add_argument('-e', '--env', action='store', dest='env', metavar='ENV', help='Compare MJD directories under this env var with TRANSFER_MIRROR_IPL_DIR', required=True)
+    parser.add_argument('-m', '--mjd', nargs='+', type=int, dest='mjd', metavar='MJD', help="Compare these MJDs, or the range 'start end' with --range", required=True)
+    parser.add_argument('-r', '--range', action='store_true', dest='range', help='Treat --mjd start end as an inclusive range')
+    parser.add_argument('-M', '--method', action='store', dest='method', metavar='METHOD', help="Compare by 'stat' (size and mtime) or by a checksum method, e.g. md5sum", default='stat')
+    parser.add_argument('-v', '--verbose', action='store_true', dest='verbose', help='Set verbose')
+    args = parser.parse_args()
+    return parser.prog, args
+
 def transfer_github():
     parser = ArgumentParser()
     parser.add_argument("-b", "--branch", help="set branch",metavar="BRANCH")
@@ -1,8 +1,8 @@
-from os import chdir, makedirs, environ, listdir
-from os.path import join, exists
+from os import makedirs, environ, listdir, walk, stat
+from os.path import join, exists, getsize
 from json import loads
 from urllib.request import urlopen
-from time import sleep
+from time import sleep, time
 from shutil import copyfile
 import tarfile
 from collections import OrderedDict
@@ -14,12 +14,13 @@ class Backup:
     crc = '-H server=archive.nersc.gov:crc:verify=all'
     perm = 0o775
 
-    def __init__(self, staging=None, observatory=None, mode=None, mjd=None, process=None, dir=None, logger=None, server=None, stage=None, verbose=None):
+    def __init__(self, staging=None, observatory=None, mode=None, mjd=None, process=None, dir=None, logger=None, server=None, stage=None, metrics=None, verbose=None):
         self.staging = staging
         self.mjd = mjd
         self.process = process
         self.dir = dir
         self.logger = logger
+        self.metrics = metrics
         self.verbose = verbose
         self.set_server(server=server)
         observatory_mode = observatory if mode=='mos' else mode
@@ -29,6 +30,7 @@ class Backup:
         self.set_cloud_staging_dir(observatory=observatory_mode)
         self.set_dir()
         self.tarfiles = OrderedDict()
+        self.journal = self.source = None
         self.ready = True
         if self.verbose: print("BACKUP> ready=%r" % self.ready)
 
@@ -58,12 +60,15 @@ class Backup:
     def set_dir(self):
         if self.mjd_dir:
             if exists(self.mjd_dir):
+                # reuse the latest run, the journal decides which of its tarballs are complete
                 ls = listdir(self.mjd_dir)
-                n = max([int(d) for d in ls]) + 1 if len(ls) > 0 else 0
+                n = max([int(d) for d in ls]) if len(ls) > 0 else 0
                 self.dir = join(self.mjd_dir, str(n))
                 try:
-                    makedirs(self.dir, self.perm)
-                    if self.verbose: print("BACKUP> CREATE: %r" % self.dir)
+                    if not exists(self.dir):
+                        makedirs(self.dir, self.perm)
+                        if self.verbose: print("BACKUP> CREATE: %r" % self.dir)
+                    elif self.verbose: print("BACKUP> USING: %r" % self.dir)
                 except Exception as e:
                     print("BACKUP> %r" % e)
                     self.dir = None
@@ -92,8 +97,7 @@ class Backup:
             boss_section = self.section in ['sos', 'spectro'] if self.section else None
             folder = join('boss',self.section) if boss_section else self.section
             self.section_dir = join(self.staging,folder) if folder else None
-            if self.section_dir and exists(self.section_dir): chdir(self.section_dir)
-            else:
+            if not self.section_dir or not exists(self.section_dir):
                 if self.verbose: print("BACKUP> Nonexistent section dir %r" % self.section_dir)
                 self.ready = False
         else: self.ready = False
@@ -112,26 +116,28 @@ class Backup:
         self.set_tar_dir()
         if self.ready:
             self.set_tarfile()
-            if self.tarfile and exists(str(self.mjd)):
-                force = True
-                if exists(self.tarfile['local']) or force==True:
-                    filemode = "w"
+            mjd_dir = join(self.section_dir, str(self.mjd))
+            if self.tarfile and exists(mjd_dir):
+                self.set_source(mjd_dir = mjd_dir)
+                if not self.is_done(unit = 'tar', file = self.tarfile['local']):
+                    tstart, filemode = (time(), "w")
                     #if self.gzip: filemode += ":gz"
-                    with tarfile.open(self.tarfile['local'], filemode) as tar: tar.add(str(self.mjd))
-                    self.tarfiles[self.section] = self.tarfile
+                    with tarfile.open(self.tarfile['local'], filemode) as tar: tar.add(mjd_dir, arcname=str(self.mjd))
+                    self.set_done(unit = 'tar', file = self.tarfile['local'], tstart = tstart)
                     self.logger.info("tar create %(local)s" % self.tarfile)
                     if self.verbose: print("BACKUP> tar %(local)s" % self.tarfile)
-                else:
-                    self.logger.warning("Found %r [skip] %r" % self.tarfile)
-                    print("Found %r [skip]" % self.tarfile)
+                self.tarfiles[self.section] = self.tarfile
             else: self.logger.warning("Skipping %r" % self.tarfile)
             
     def copy_to_hpss_staging(self):
         source = self.tarfile['local']
         destination = self.tarfile['hpss-staging']
         try:
-            if exists(source):
+            if self.is_done(unit = 'hpss', file = destination): pass
+            elif exists(source):
+                tstart = time()
                 copyfile(source, destination)
+                self.set_done(unit = 'hpss', file = destination, tstart = tstart)
                 self.logger.warning("HPSS STAGING> %(hpss-staging)s" % self.tarfile)
                 if self.verbose: print("HPSS STAGING> %(hpss-staging)s" % self.tarfile)
             else:
@@ -144,8 +150,9 @@ class Backup:
     def zstd_to_cloud_staging(self):
         source = self.tarfile['local']
         destination = self.tarfile['cloud-staging']
-        if exists(source):
-            threads = 12
+        if self.is_done(unit = 'zstd', file = destination): pass
+        elif exists(source):
+            tstart, threads = (time(), 12)
             chunk_size = 32 * 1024 * 1024  
             try:
                 zstd_compressor = ZstdCompressor(level=12, threads=threads)
@@ -154,6 +161,7 @@ class Backup:
                         with zstd_compressor.stream_writer(file) as compressor:
                             while chunk := tarball.read(chunk_size):
                                 compressor.write(chunk)
+                self.set_done(unit = 'zstd', file = destination, tstart = tstart)
                 self.logger.warning("CLOUD STAGING> %(cloud-staging)s" % self.tarfile)
                 if self.verbose: print("CLOUD STAGING> %(cloud-staging)s" % self.tarfile)
             except Exception as e:
@@ -162,3 +170,26 @@ class Backup:
         else:
             self.logger.warning("CLOUD STAGING> Non-existent %(local)s" % self.tarfile)
             print("CLOUD STAGING> Missing path=%(local)r" % self.tarfile)
+
+    def set_source(self, mjd_dir=None):
+        count, size, mtime = (0, 0, 0)
+        for root, dirs, files in walk(mjd_dir):
+            for file in files:
+                try: st = stat(join(root, file))
+                except OSError: continue
+                count, size, mtime = (count + 1, size + st.st_size, max(mtime, st.st_mtime_ns))
+        self.source = [count, size, mtime]
+
+    def is_done(self, unit=None, file=None):
+        entry = self.journal.get(unit, file = file, source = self.source) if self.journal and file else None
+        done = True if entry and exists(file) and getsize(file) == entry.get('size') else False
+        if done:
+            self.logger.info("Journal shows %s %s done [skip]" % (unit, file))
+            if self.verbose: print("BACKUP> Journal shows %s %s done [skip]" % (unit, file))
+        return done
+
+    def set_done(self, unit=None, file=None, tstart=None):
+        if self.journal and file and exists(file): self.journal.record(unit = unit, file = file, size = getsize(file), source = self.source)
+        if self.metrics is not None and file and exists(file):
+            self.metrics.set('backup_bytes', getsize(file), section = self.section, step = unit)
+            if tstart: self.metrics.set('backup_duration_seconds', round(time() - tstart, 1), section = self.section, step = unit)
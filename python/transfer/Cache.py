@@ -0,0 +1,76 @@
+from os import environ, makedirs
+from os.path import join, exists, expanduser
+from sqlite3 import connect
+from threading import Lock
+from time import time
+
+class Cache:
+
+    name = '.checksum.sqlite'
+    timeout = 60
+    perm = 0o775
+
+    def __init__(self, dir=None, file=None, verbose=False):
+        self.verbose = verbose
+        self.lock = Lock()
+        self.pending = []
+        self.hits = self.misses = 0
+        self.set_file(dir = dir, file = file)
+        self.set_connection()
+
+    def set_file(self, dir=None, file=None):
+        self.file = file if file else environ.get('TRANSFER_CHECKSUM_CACHE')
+        if not self.file:
+            # keep the cache out of the data trees it audits, in the given dir or else the user's cache dir
+            dir = dir if dir else join(environ.get('XDG_CACHE_HOME') or expanduser('~/.cache'), 'transfer')
+            try:
+                if not exists(dir): makedirs(dir, self.perm)
+                self.file = join(dir, self.name)
+            except Exception as e: print("CACHE> %r" % e)
+        if self.verbose: print("CACHE> file=%r" % self.file)
+
+    def set_connection(self):
+        self.connection = None
+        if self.file:
+            try:
+                # the default rollback journal, since WAL does not work for verifiers on several hosts sharing the file over NFS or GPFS
+                self.connection = connect(self.file, timeout = self.timeout, check_same_thread = False)
+                self.connection.execute("CREATE TABLE IF NOT EXISTS digest (device INTEGER, inode INTEGER, algorithm TEXT, size INTEGER, mtime_ns INTEGER, digest TEXT, stamp REAL, PRIMARY KEY (device, inode, algorithm))")
+                self.connection.commit()
+            except Exception as e:
+                print("CACHE> %r" % e)
+                self.connection = None
+        self.ready = self.connection is not None
+
+    def get(self, stat=None, algorithm=None):
+        digest = None
+        if self.ready and stat:
+            with self.lock:
+                try: row = self.connection.execute("SELECT size, mtime_ns, digest FROM digest WHERE device=? AND inode=? AND algorithm=?", (stat.st_dev, stat.st_ino, algorithm)).fetchone()
+                except Exception as e:
+                    print("CACHE> %r" % e)
+                    row = None
+                if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns: digest = row[2]
+                if digest: self.hits += 1
+                else: self.misses += 1
+        return digest
+
+    def put(self, stat=None, algorithm=None, digest=None):
+        if self.ready and stat and digest:
+            with self.lock: self.pending.append((stat.st_dev, stat.st_ino, algorithm, stat.st_size, stat.st_mtime_ns, digest, time()))
+
+    def commit(self):
+        if self.ready:
+            with self.lock:
+                try:
+                    if self.pending:
+                        self.connection.executemany("INSERT OR REPLACE INTO digest VALUES (?,?,?,?,?,?,?)", self.pending)
+                        self.connection.commit()
+                except Exception as e: print("CACHE> %r" % e)
+                if self.verbose: print("CACHE> hits=%r misses=%r stored=%r" % (self.hits, self.misses, len(self.pending)))
+                self.pending = []
+
+    def close(self):
+        self.commit()
+        if self.connection: self.connection.close()
+        self.connection, self.ready = (None, False)
@@ -0,0 +1,141 @@
+from os import cpu_count, fstat, stat, replace, getpid
+from os.path import join, isabs
+from hashlib import new
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from time import time
+try: from xxhash import xxh3_128
+except ImportError: xxh3_128 = None
+try: from blake3 import blake3
+except ImportError: blake3 = None
+
+class Checksum:
+
+    algorithms = {'md5sum': 'md5', 'sha1sum': 'sha1', 'sha224sum': 'sha224', 'sha256sum': 'sha256', 'sha384sum': 'sha384', 'sha512sum': 'sha512', 'b2sum': 'blake2b', 'xxh128sum': 'xxh3_128', 'b3sum': 'blake3'}
+    constructors = {'xxh3_128': xxh3_128, 'blake3': blake3}
+    modules = {'xxh3_128': 'xxhash', 'blake3': 'blake3'}
+    buffer_size = 8 * 1024 * 1024
+    statuses = ['OK', 'FAILED', 'MISSING', 'ERROR']
+
+    def __init__(self, method=None, manifest=None, workers=None, cache=None, logger=None, verbose=False):
+        self.workers = workers if workers else min(32, (cpu_count() or 1) * 2)
+        self.cache = cache
+        self.logger = logger
+        self.verbose = verbose
+        self.set_algorithm(method = method)
+        self.set_manifest(manifest = manifest)
+        self.results = []
+
+    def set_algorithm(self, method=None):
+        # accept the ini form, e.g. "md5sum --check"
+        self.method = method.split(' ')[0] if method else 'md5sum'
+        self.algorithm = self.get_algorithm(method = self.method)
+        self.ready = self.algorithm is not None
+
+    def set_manifest(self, manifest=None):
+        self.manifest = manifest.split(' ')[0] if manifest else None
+        self.manifest_algorithm = self.get_algorithm(method = self.manifest) if self.manifest else None
+        # the companion manifest is hashed in the same read as the sumfile check
+        self.hashes = [algorithm for algorithm in (self.algorithm, self.manifest_algorithm) if algorithm]
+        if self.manifest_algorithm == self.algorithm: self.hashes = self.hashes[:1]
+
+    def get_algorithm(self, method=None):
+        algorithm = self.algorithms.get(method)
+        if algorithm is None: self.error_message("Unsupported checksum method=%r" % method)
+        elif algorithm in self.constructors and self.constructors[algorithm] is None:
+            self.error_message("Checksum method=%r requires the %s module" % (method, self.modules[algorithm]))
+            algorithm = None
+        return algorithm
+
+    def new(self, algorithm=None):
+        constructor = self.constructors.get(algorithm)
+        return constructor() if constructor else new(algorithm)
+
+    def parse(self, sumfile=None):
+        entries = []
+        with open(sumfile, errors='surrogateescape') as lines:
+            for line in lines:
+                line = line.rstrip("\n")
+                escaped = line.startswith("\\")
+                if escaped: line = line[1:]
+                try: digest, file = line.split(' ', 1)
+                except ValueError: continue
+                if not digest or not file: continue
+                # "digest  file" in text mode, "digest *file" in binary mode
+                file = file[1:] if file[0] in ' *' else file
+                if escaped: file = file.replace("\\n", "\n").replace("\\\\", "\\")
+                entries.append((file, digest.lower()))
+        return entries
+
+    def digest(self, path=None):
+        before = stat(path) if self.cache is not None else None
+        digests = {algorithm: self.cache.get(stat = before, algorithm = algorithm) for algorithm in self.hashes} if before else {}
+        hashes = {algorithm: self.new(algorithm = algorithm) for algorithm in self.hashes if not digests.get(algorithm)}
+        if not hashes: return digests, before.st_size
+        with open(path, 'rb', buffering=0) as file:
+            size = fstat(file.fileno()).st_size
+            buffer = memoryview(bytearray(min(self.buffer_size, max(size, 1))))
+            # hashlib releases the GIL on large updates, so the pool hashes files in parallel
+            while nbytes := file.readinto(buffer):
+                chunk = buffer[:nbytes]
+                for hash in hashes.values(): hash.update(chunk)
+            after = fstat(file.fileno())
+        # only cache a digest of a file that did not change while it was read
+        unchanged = before and (before.st_ino, before.st_size, before.st_mtime_ns) == (after.st_ino, after.st_size, after.st_mtime_ns)
+        for algorithm, hash in hashes.items():
+            digests[algorithm] = hash.hexdigest()
+            if unchanged: self.cache.put(stat = before, algorithm = algorithm, digest = digests[algorithm])
+        return digests, size
+
+    def check_file(self, entry=None, dir=None):
+        file, expected = entry
+        result = OrderedDict([('file', file), ('expected', expected), ('digest', None), ('manifest', None), ('size', None), ('status', None), ('error', None)])
+        try:
+            digests, result['size'] = self.digest(path = file if isabs(file) or not dir else join(dir, file))
+            result['digest'], result['manifest'] = (digests.get(self.algorithm), digests.get(self.manifest_algorithm))
+            result['status'] = 'OK' if result['digest'] == expected else 'FAILED'
+        except FileNotFoundError as e: result['status'], result['error'] = ('MISSING', "%r" % e)
+        except OSError as e: result['status'], result['error'] = ('ERROR', "%r" % e)
+        return result
+
+    def check(self, sumfile=None, dir=None):
+        self.results = []
+        if self.ready and sumfile:
+            tstart = time()
+            entries = self.parse(sumfile = sumfile)
+            with ThreadPoolExecutor(max_workers = self.workers) as executor:
+                self.results = list(executor.map(lambda entry: self.check_file(entry = entry, dir = dir), entries))
+            if self.cache is not None: self.cache.commit()
+            self.seconds = time() - tstart
+            self.set_count()
+        return self.results
+
+    def set_count(self):
+        self.count = OrderedDict([(status, 0) for status in self.statuses])
+        for result in self.results: self.count[result['status']] += 1
+        self.nbytes = sum([result['size'] for result in self.results if result['size']])
+        self.ok = self.count['OK'] == len(self.results)
+        message = "%s %r files [%s] %.1f GB in %.1fs" % (self.method, len(self.results), ", ".join(["%s=%r" % item for item in self.count.items() if item[1]]), self.nbytes / 1e9, self.seconds)
+        if self.logger: self.logger.info(message)
+        if self.verbose: print("CHECKSUM> %s" % message)
+
+    def write_manifest(self, file=None):
+        written = False
+        if file and self.manifest_algorithm and self.results and self.ok:
+            temp = "%s.%r.tmp" % (file, getpid())
+            try:
+                with open(temp, 'w', errors='surrogateescape') as manifest:
+                    for result in self.results: manifest.write("%s  %s\n" % (result['manifest'], result['file']))
+                replace(temp, file)
+                written = True
+                if self.logger: self.logger.info("Write %s manifest %s" % (self.manifest, file))
+                if self.verbose: print("CHECKSUM> Write %s manifest %r" % (self.manifest, file))
+            except Exception as e: self.error_message("Failed to write manifest %r: %r" % (file, e))
+        return written
+
+    def get_failures(self): return [result for result in self.results if result['status'] != 'OK']
+
+    def error_message(self, message=None):
+        if message:
+            if self.logger: self.logger.error(message)
+            if self.verbose: print("CHECKSUM> %s" % message)
@@ -7,6 +7,8 @@ from shutil import rmtree
 
 class Copy:
 
+    timeout = 86400
+
     def __init__(self, staging=None, source=None, destination=None, mjd=None, log_dir=None,  resources_path=None, process=None, logger=None, verbose=None):
         self.staging = staging
         self.mjd = mjd
@@ -31,13 +33,17 @@ class Copy:
         self.set_ready()
     
     def set_destination(self, path=None, env=None, partition=None):
+        self.destination = path if path else self.get_destination(env=env, partition=partition)
+        self.set_ready()
+
+    def get_destination(self, env=None, partition=None):
         try:
-            self.destination = path if path else environ[env] if env else None
-            if partition and self.destination and self.destination.startswith(self.base_dir) and self.base_dir and not self.base_dir.endswith(partition):
+            destination = environ[env] if env else None
+            if partition and destination and destination.startswith(self.base_dir) and self.base_dir and not self.base_dir.endswith(partition):
                 partition_dir = join(dirname(self.base_dir), partition) if self.base_dir and partition else None
-                self.destination = self.destination.replace(self.base_dir, partition_dir, 1)
-        except: self.destination = None
-        self.set_ready()
+                destination = destination.replace(self.base_dir, partition_dir, 1)
+        except: destination = None
+        return destination
     
     def set_ready(self):
         self.ready = False
@@ -50,7 +56,7 @@ class Copy:
         if self.ready:
             command = "rsync --archive --verbose {source}/{mjd}/ {destination}/{mjd}/".format(source=self.source,destination=self.destination,mjd=self.mjd)
             if self.verbose: print("COPY> %r" % command)
-            self.process.run(command)
+            self.process.run(command, timeout=self.timeout)
             if self.process.status:
                 self.ready = False
                 self.logger.critical("Error detected while copying {source}/{mjd}.".format(source=self.source,mjd=self.mjd))
@@ -73,7 +79,7 @@ class Copy:
     def drop_empty(self):
         if self.ready:
             command = "find {destination} -maxdepth 1 -type d -empty -delete".format(destination=self.destination)
-            self.process.run(command)
+            self.process.run(command, timeout=self.timeout)
             if self.process.status:
                 self.ready = False
                 self.logger.critical("Error detected while removing empty directories in {destination}.".format(destination=self.destination))
@@ -2,6 +2,7 @@ import os
 from sys import stdout
 from time import time, sleep
 import logging
+import re
 import globus_sdk
 
 from globus_sdk.token_storage import JSONTokenStorage
@@ -16,8 +17,11 @@ class Globus:
     
     endpoints = ['source', 'destination']
 
-    def __init__(self, logger = None, verbose = None):
+    states = ["ACTIVE", "INACTIVE", "SUCCEEDED", "FAILED"]
+
+    def __init__(self, logger = None, metrics = None, verbose = None):
         self.logger = logger if logger else logging.getLogger("sdss_transfer.globus")
+        self.metrics = metrics
         self.verbose = True# verbose
         self.client_id = os.environ.get("TRANSFER_CLIENT_ID")
         self.source_endpoint = os.environ.get("TRANSFER_SAS_ENDPOINT")
@@ -247,6 +251,7 @@ class Globus:
                 # Refresh the task object from the Globus API
                 self.task = self.client.get_task(self.task_id)
                 self.status = self.task["status"]
+                self.set_metrics(seconds = time.time() - start_time)
                 
                 if self.verbose:
                     # Dynamically calculate progress metrics
@@ -287,3 +292,13 @@ class Globus:
                 self.logger.warning(f"WARNING: Transfer task {self.task_id} finished with unexpected status={self.status}")
         else: 
             self.status = None
+
+    def set_metrics(self, seconds = None):
+        if self.metrics is not None and self.task:
+            label = self.task.get("label") or "sdss-transfer"
+            # the label ends in the MJD, which would give every night its own series
+            label = re.sub(r'\.\d+$', '', label)
+            self.metrics.set_state("globus_task_state", state = self.status, states = self.states, task = label)
+            self.metrics.set("globus_bytes_transferred", self.task.get("bytes_transferred", 0), task = label)
+            self.metrics.set("globus_files_transferred", self.task.get("files_transferred", 0), task = label)
+            self.metrics.set("globus_duration_seconds", round(seconds, 1), task = label)
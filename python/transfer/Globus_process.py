@@ -6,12 +6,15 @@ from urllib.request import urlopen
 from time import sleep
 import tarfile
 from collections import OrderedDict
+from transfer.Process import Command
 
 class Globus_process:
 
     ext = ['txt', 'log', 'err']
     sync = ['exists', 'size', 'mtime', 'checksum']
     identifier_length = 36
+    timeout = 300
+    wait_timeout = 86400
     
     def __init__(self, staging=None, observatory=None, mode=None, mjd=None, sam=None, hpss=None, process=None, logger=None, dir=None, scratch_dir=None, verbose=None):
         self.staging = staging
@@ -41,12 +44,12 @@ class Globus_process:
         else: self.sam_endpoint = None
         if hpss: self.set_hpss_endpoint()
         else: self.hpss_endpoint = None
+        self.set_endpoint_targets(targets = [self.sas_endpoint, self.hpss_endpoint])
     
     def set_sas_endpoint(self, hpss=None):
         target = self.sas_endpoint = {'endpoint': 'SAS'}
         try: self.sas_endpoint['id'] = environ['TRANSFER_SAS_ENDPOINT']
         except: self.sas_endpoint['id'] = None
-        self.set_endpoint_target(target=target)
         self.set_endpoint_base_dir(target=target, hpss=hpss)
 
     def set_sam_endpoint(self):
@@ -60,7 +63,6 @@ class Globus_process:
         target = self.hpss_endpoint = {'endpoint': 'HPSS'}
         try: self.hpss_endpoint['id'] = environ['TRANSFER_HPSS_ENDPOINT']
         except: self.hpss_endpoint['id'] = None
-        self.set_endpoint_target(target=target)
         self.set_endpoint_base_dir(target=target)
 
     def set_endpoint_base_dir(self, target=None, hpss=None):
@@ -109,29 +111,35 @@ class Globus_process:
                 target['status'] = 'Endpoint ID?'
                 target['active'] = None
                 
-    def set_endpoint_target(self, target):
+    def set_endpoint_targets(self, targets=None):
+        targets = [target for target in targets if target] if targets else []
+        commands = [Command(command="globus endpoint is-activated %(id)s" % target, timeout=self.timeout) for target in targets if target['id']]
+        if commands: self.process.run_concurrent(commands=commands)
+        for target in targets:
+            command = commands.pop(0) if target['id'] else None
+            self.set_endpoint_target(target=target, command=command)
+
+    def set_endpoint_target(self, target, command=None):
         if target:
-            if target['id']:
-                command = "globus endpoint is-activated %(id)s" % target
-                self.process.run(command)
-                if not self.process.status:
-                    lines = [line for line in self.process.out.split("\n") if line]
+            if target['id'] and command:
+                if not command.status:
+                    lines = [line for line in command.out.split("\n") if line]
                     response = lines[0] if len(lines)==1 else None
                     active_response = "%(id)s is activated" % target
                     alternate_response = "%(id)s does not require activation" % target
                     inactive_response = "The endpoint is not activated." % target
                     target['status'] = "active" if active_response else "personal endpoint (activation not required)" if alternate_response else "inactive"
                     target['active'] = response == active_response or alternate_response
-                elif self.process.status==1:
-                    target['status'] = 'inactive (status code %r)' % self.process.status
+                elif command.status==1:
+                    target['status'] = 'inactive (status code %r)' % command.status
                     target['active'] = False
                     self.ready = False
-                    if self.verbose: print("GLOBUS> %r" % self.process.out)
+                    if self.verbose: print("GLOBUS> %r" % command.out)
                 else:
-                    target['status'] = 'inactive (status code %r)' % self.process.status
+                    target['status'] = 'inactive (status code %r)' % command.status
                     target['active'] = None
                     self.ready = False
-                    if self.verbose: print("GLOBUS> Endpoint Error status code %r (bad syntax)" % self.process.status)
+                    if self.verbose: print("GLOBUS> Endpoint Error status code %r (bad syntax)" % command.status)
             else:
                 target['status'] = 'Endpoint ID?'
                 target['active'] = None
@@ -177,7 +185,7 @@ class Globus_process:
     def set_whoami(self):
         if self.ready:
             command = "globus whoami"
-            self.process.run(command)
+            self.process.run(command, timeout=self.timeout)
             if self.process.status:
                 self.whoami = None
                 self.ready = False
@@ -287,7 +295,7 @@ class Globus_process:
             if self.verbose:
                 print("GLOBUS> %r" % command)
             #self.process.run(command, batch=self.options['batch']) older versions of cli
-            self.process.run(command)
+            self.process.run(command, timeout=self.timeout)
             if self.process.status:
                 self.ready = False
                 self.logger.error("GLOBUS> Error status code %r" % self.process.status)
@@ -303,7 +311,7 @@ class Globus_process:
         if self.identifier:
             command = "globus task wait %s" % self.identifier
             if self.verbose: print("GLOBUS> Wait...")
-            self.process.run(command)
+            self.process.run(command, timeout=self.wait_timeout)
             if self.process.status:
                 self.ready = False
                 self.logger.error("GLOBUS> Error status code %r" % self.process.status)
@@ -312,7 +320,7 @@ class Globus_process:
         self.details = None
         if self.identifier:
             command = "globus task show %s" % self.identifier
-            self.process.run(command)
+            self.process.run(command, timeout=self.timeout)
             if self.process.status:
                 self.ready = False
                 self.logger.error("GLOBUS> Error status code %r" % self.process.status)
@@ -0,0 +1,88 @@
+from os import makedirs, fsync, unlink
+from os.path import join, exists
+from json import dumps, loads
+from time import time
+from threading import Lock
+from collections import OrderedDict
+
+class Journal:
+
+    ext = '.journal.jsonl'
+    perm = 0o775
+
+    def __init__(self, dir=None, mjd=None, section=None, stage=None, restart=False, verbose=False):
+        self.mjd = mjd
+        self.section = section
+        self.stage = stage
+        self.restart = restart
+        self.verbose = verbose
+        self.lock = Lock()
+        self.set_dir(dir = dir)
+        self.set_file()
+        self.set_units()
+
+    def set_dir(self, dir=None):
+        try:
+            self.dir = dir
+            if self.dir and not exists(self.dir): makedirs(self.dir, self.perm)
+        except Exception as e:
+            print("JOURNAL> %r" % e)
+            self.dir = None
+
+    def set_file(self):
+        key = [str(value) for value in (self.mjd, self.section, self.stage) if value]
+        self.name = ".".join(key) if key else None
+        self.file = join(self.dir, self.name + self.ext) if self.dir and self.name else None
+
+    def set_units(self):
+        self.units = OrderedDict()
+        if self.file and exists(self.file):
+            if self.restart:
+                open(self.file, 'w').close()
+                if self.verbose: print("JOURNAL> RESTART %r" % self.file)
+            else:
+                with open(self.file) as file: lines = file.read()
+                for line in lines.splitlines():
+                    # a crash may leave a torn last line, which only loses that unit
+                    try: entry = loads(line)
+                    except ValueError: continue
+                    if entry.get('status') == 'discard': self.units.pop(entry.get('unit'), None)
+                    else: self.units[entry.get('unit')] = entry
+                if lines and not lines.endswith("\n"):
+                    with open(self.file, 'a') as file: file.write("\n")
+                if self.verbose: print("JOURNAL> %r completed units in %r" % (len(self.units), self.file))
+
+    def get(self, unit=None, **check):
+        entry = self.units.get(unit)
+        return entry if entry and all([entry.get(key) == value for key, value in check.items()]) else None
+
+    def done(self, unit=None, **check): return self.get(unit, **check) is not None
+
+    def record(self, unit=None, status='done', **data):
+        if unit:
+            entry = OrderedDict([('unit', unit), ('status', status), ('stamp', time())])
+            entry.update(data)
+            with self.lock:
+                if self.file:
+                    try:
+                        with open(self.file, 'a') as file:
+                            file.write(dumps(entry, separators=(',',':')) + "\n")
+                            file.flush()
+                            fsync(file.fileno())
+                    except Exception as e:
+                        print("JOURNAL> %r" % e)
+                        self.file = None
+                if status == 'discard': self.units.pop(unit, None)
+                else: self.units[unit] = entry
+            if self.verbose: print("JOURNAL> %s %s %s" % (self.name, status, unit))
+
+    def discard(self, unit=None):
+        if unit in self.units: self.record(unit = unit, status = 'discard')
+
+    def clear(self):
+        with self.lock:
+            self.units = OrderedDict()
+            if self.file and exists(self.file):
+                try: unlink(self.file)
+                except Exception as e: print("JOURNAL> %r" % e)
+        if self.verbose: print("JOURNAL> CLEAR %r" % self.file)
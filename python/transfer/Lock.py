@@ -0,0 +1,78 @@
+from fcntl import flock, LOCK_EX, LOCK_NB, LOCK_UN
+from os import environ, getpid, makedirs
+from os.path import join, exists
+
+class Lock:
+
+    perm = 0o775
+
+    def __init__(self, program=None, observatory=None, mode=None, mjd=None, section=None, dir=None, verbose=False):
+        self.program = program if program else "transfer"
+        self.observatory = observatory
+        self.mode = mode
+        self.mjd = mjd
+        self.section = section
+        self.verbose = verbose
+        self.handle = self.pid = self.holder = None
+        self.locked = False
+        self.set_dir(dir = dir)
+        self.set_file()
+
+    def __enter__(self):
+        self.acquire(blocking = True)
+        return self
+
+    def __exit__(self, *args): self.release()
+
+    def set_dir(self, dir=None):
+        try:
+            self.dir = dir if dir else join('/tmp', environ['USER'], self.program)
+            if not exists(self.dir): makedirs(self.dir, self.perm)
+        except Exception as e:
+            print("LOCK> %r" % e)
+            self.dir = None
+
+    def set_file(self):
+        key = [str(value) for value in (self.observatory, self.mode, self.mjd, self.section) if value]
+        self.name = ".".join(key) if key else self.program
+        self.file = join(self.dir, "%s.lock" % self.name) if self.dir else None
+
+    def acquire(self, blocking=False):
+        if not self.locked and self.file:
+            self.handle = open(self.file, 'a+')
+            try:
+                flock(self.handle, LOCK_EX if blocking else LOCK_EX | LOCK_NB)
+                self.locked = True
+            except BlockingIOError:
+                self.set_holder()
+                self.handle.close()
+                self.handle = None
+                if self.verbose: print("LOCK> %s held by pid=%r [%s]" % (self.name, self.pid, self.holder))
+            if self.locked:
+                self.handle.seek(0)
+                self.handle.truncate()
+                self.handle.write("%r\n" % getpid())
+                self.handle.flush()
+                self.pid, self.holder = (getpid(), None)
+                if self.verbose: print("LOCK> %s acquired by pid=%r" % (self.name, self.pid))
+        elif not self.file: self.locked = True
+        return self.locked
+
+    def release(self):
+        if self.locked and self.handle:
+            self.handle.seek(0)
+            self.handle.truncate()
+            flock(self.handle, LOCK_UN)
+            self.handle.close()
+            if self.verbose: print("LOCK> %s released" % self.name)
+        self.handle = None
+        self.locked = False
+
+    def set_holder(self):
+        try:
+            self.handle.seek(0)
+            self.pid = int(self.handle.readline().strip())
+        except (ValueError, OSError): self.pid = None
+        try:
+            with open("/proc/%r/cmdline" % self.pid, 'rb') as cmdline: self.holder = cmdline.read().replace(b'\0', b' ').decode(errors='replace').strip()
+        except (OSError, TypeError): self.holder = None
@@ -21,6 +21,7 @@ class Logging:
         self.logger = None
         self.filehandler = None
         self.smtphandler = None
+        self.stage_handlers = None
         self.set_mjd_dir()
         self.set_dir(dir = dir)
         self.set_mailhost()
@@ -42,11 +43,21 @@ class Logging:
         except: self.email = None
     
     def set_stage(self, stage=None):
-        self.stage = "transfer.%s" % self.observatory
-        if self.mode: self.stage += "-%s" % self.mode
-        if stage: self.stage += ".%s" % stage
+        self.stage = self.get_stage(stage = stage)
+        self.name = self.get_name(stage = stage)
         self.set_ready()
 
+    def get_stage(self, stage=None):
+        name = "transfer.%s" % self.observatory
+        if self.mode: name += "-%s" % self.mode
+        if stage: name += ".%s" % stage
+        return name
+
+    def get_name(self, stage=None):
+        # loggers are process-wide, so the MJD keeps the loggers of a backfill apart
+        name = "%s.%r" % (self.get_stage(), self.mjd) if self.mjd else self.get_stage()
+        return "%s.%s" % (name, stage) if stage else name
+
     def set_mjd_dir(self):
         self.mjd_log_dir = join(self.staging,self.log_dir,str(self.mjd)) if self.staging and self.log_dir and self.mjd else None
         if self.mjd_log_dir:
@@ -79,27 +90,32 @@ class Logging:
         log = "%r.log" % self.mjd if self.mjd else "log"
         log = "transfer.%s-%s.%s" % (self.observatory, self.mode, log) if self.observatory and self.mode else "transfer.%s.%s" % (self.observatory, log) if self.observatory else None
         self.file = join(self.dir, log) if self.dir and log else None
+        self.trace_file = join(self.dir, log[:-len('.log')] + '.trace.jsonl') if self.dir and log else None
     
     def set_ready(self):
         if self.logger is None: self.set_logger()
-        elif self.logger.handlers:
-            if self.filehandler in self.logger.handlers: self.logger.removeHandler(self.filehandler)
-            if self.smtphandler in self.logger.handlers: self.logger.removeHandler(self.smtphandler)
-        self.set_filehandler()
+        elif self.smtphandler in self.logger.handlers: self.logger.removeHandler(self.smtphandler)
+        if self.filehandler is None: self.set_filehandler()
         self.set_mailhosthandler()
         self.ready = True if self.dir is not None and self.logger is not None else False
     
     def set_logger(self):
-         self.logger = logging.getLogger(self.stage) if self.stage else None
+         self.logger = logging.getLogger(self.name) if self.name else None
          if self.logger:
+            self.logger.propagate = False
+            self.logger.addFilter(self.add_stage)
             if self.debug: self.logger.setLevel(logging.DEBUG)
             else: self.logger.setLevel(logging.INFO)
 
+    def add_stage(self, record):
+        record.stage = self.stage
+        return True
+
     def set_filehandler(self):
         if self.logger and self.file:
+            # one handler owns the log file, since two handlers rotating the same file lose lines at rollover
             self.filehandler = RotatingFileHandler(self.file, maxBytes=10485760, backupCount=5)
-            format = "%(asctime)s - {stage} - %(levelname)s - %(message)s".format(stage=self.stage)
-            formatter = logging.Formatter(format, self.time_format)
+            formatter = logging.Formatter("%(asctime)s - %(stage)s - %(levelname)s - %(message)s", self.time_format)
             self.filehandler.setFormatter(formatter)
             self.logger.addHandler(self.filehandler)
 
@@ -111,3 +127,24 @@ class Logging:
             self.smtphandler.setFormatter(formatter)
             self.smtphandler.setLevel(logging.CRITICAL)
             self.logger.addHandler(self.smtphandler)
+
+    def get_logger(self, stage=None):
+        logger = logging.getLogger(self.get_name(stage = stage))
+        if self.stage_handlers is None: self.set_stage_handlers()
+        if not logger.handlers:
+            name = self.get_stage(stage = stage)
+            logger.propagate = False
+            logger.setLevel(logging.DEBUG if self.debug else logging.INFO)
+            logger.addFilter(lambda record: setattr(record, 'stage', name) or True)
+            for handler in self.stage_handlers: logger.addHandler(handler)
+        return logger
+
+    def set_stage_handlers(self):
+        self.stage_handlers = []
+        if self.filehandler is None: self.set_filehandler()
+        if self.filehandler: self.stage_handlers.append(self.filehandler)
+        if self.mailhost and self.email and self.recipients:
+            handler = SMTPHandler(self.mailhost, self.email, self.recipients, "Critical error reported by transfer.%s for MJD=%r." % (self.observatory, self.mjd))
+            handler.setFormatter(logging.Formatter("At %(asctime)s, %(name)s failed with this message:\n\n%(message)s\n\nSincerely, sdssadmin on behalf of the SDSS data team!", self.time_format))
+            handler.setLevel(logging.CRITICAL)
+            self.stage_handlers.append(handler)
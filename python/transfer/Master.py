@@ -0,0 +1,65 @@
+from os import makedirs, getuid, getpid
+from os.path import join, exists
+from subprocess import run, DEVNULL, TimeoutExpired
+from threading import Lock
+from tempfile import gettempdir
+
+class Master:
+
+    timeout = 60
+    persist = 900
+    perm = 0o700
+
+    def __init__(self, host=None, port=None, logger=None, verbose=False):
+        self.host = host
+        self.port = port
+        self.logger = logger
+        self.verbose = verbose
+        self.lock = Lock()
+        self.ready = self.owner = False
+        self.set_path()
+
+    def set_path(self):
+        # %C hashes the local host, remote host, port and user, so the path is short and only matches this host
+        # the pid keeps concurrent jobs on their own masters, so one job's teardown cannot cut off another's streams
+        dir = join(gettempdir(), "transfer-ssh-%r" % getuid())
+        try:
+            if not exists(dir): makedirs(dir, self.perm)
+            self.path = join(dir, "%r-%%C" % getpid())
+        except Exception as e:
+            print("MASTER> %r" % e)
+            self.path = None
+
+    def get_options(self): return "-o ControlMaster=no -o ControlPath=%s" % self.path if self.ready else ""
+
+    def get_command(self, *options):
+        command = ["ssh", "-o", "ControlPath=%s" % self.path]
+        if self.port: command += ["-p", str(self.port)]
+        return command + list(options) + [self.host]
+
+    def start(self):
+        with self.lock:
+            if not self.ready and self.host and self.path:
+                self.ready = self.execute(self.get_command("-O", "check"))
+                if not self.ready: self.ready = self.owner = self.execute(self.get_command("-fNM", "-o", "ControlPersist=%r" % self.persist, "-o", "ServerAliveInterval=30"))
+                self.info_message("%s ControlMaster for %s" % ("Started" if self.ready else "Failed to start", self.host))
+        return self.ready
+
+    def stop(self):
+        with self.lock:
+            if self.ready and self.owner:
+                self.execute(self.get_command("-O", "exit"))
+                self.info_message("Stopped ControlMaster for %s" % self.host)
+            self.ready = self.owner = False
+
+    def execute(self, command=None):
+        # ssh -f keeps the inherited descriptors open in the background, so none are piped back here
+        try: return run(command, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, timeout=self.timeout).returncode == 0
+        except (OSError, TimeoutExpired) as e:
+            self.info_message("%r" % e)
+            return False
+
+    def info_message(self, message=None):
+        if message:
+            if self.logger: self.logger.info("MASTER> %s" % message)
+            if self.verbose: print("MASTER> %s" % message)
@@ -0,0 +1,159 @@
+from os import environ, makedirs, replace, getpid
+from os.path import join, exists
+from fcntl import flock, LOCK_EX
+import re
+from time import time
+from threading import Lock
+from collections import OrderedDict
+from contextlib import contextmanager
+
+class Metrics:
+
+    prefix = 'transfer'
+    perm = 0o775
+    line_pattern = re.compile(r'^%s_(\w+)\{(.*)\} (\S+)$' % prefix)
+    label_pattern = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+    types = {
+        'stage_bytes': ('gauge', 'Bytes moved by the last run of a stage'),
+        'stage_files': ('gauge', 'Files moved by the last run of a stage'),
+        'stage_duration_seconds': ('gauge', 'Wall time of the last run of a stage'),
+        'stage_rate_bytes_per_second': ('gauge', 'Throughput of the last run of a stage'),
+        'stage_status': ('gauge', 'Status of the last run of a stage'),
+        'stage_timestamp_seconds': ('gauge', 'Unix time the stage last finished'),
+        'queue_depth': ('gauge', 'Sections waiting or running in the stage scheduler'),
+        'retries_total': ('counter', 'Units of work retried after a failure'),
+        'rsync_files_total': ('counter', 'Files moved by rsync streams that exited without error'),
+        'rsync_stream_failures_total': ('counter', 'Rsync streams that exited with an error'),
+        'rsync_streams': ('gauge', 'Rsync streams chosen by the autotuner'),
+        'rsync_rate_bytes_per_second': ('gauge', 'Throughput of the rsync streams of a section'),
+        'rsync_files_transferred': ('gauge', 'Files transferred so far by the rsync streams of a section'),
+        'rsync_bytes_transferred': ('gauge', 'Bytes transferred so far by the rsync streams of a section'),
+        'rsync_eta_seconds': ('gauge', 'Estimated seconds left for the rsync streams of a section'),
+        'backup_bytes': ('gauge', 'Bytes written by a backup step'),
+        'backup_duration_seconds': ('gauge', 'Wall time of a backup step'),
+        'globus_task_state': ('gauge', 'Current state of a Globus task'),
+        'globus_bytes_transferred': ('gauge', 'Bytes transferred so far by a Globus task'),
+        'globus_files_transferred': ('gauge', 'Files transferred so far by a Globus task'),
+        'globus_duration_seconds': ('gauge', 'Time spent waiting on a Globus task'),
+        'last_mjd': ('gauge', 'MJD of the last run of a stage'),
+        'write_timestamp_seconds': ('gauge', 'Unix time this file was written'),
+    }
+
+    def __init__(self, observatory=None, mode=None, dir=None, verbose=False):
+        self.observatory = observatory
+        self.mode = mode
+        self.verbose = verbose
+        self.lock = Lock()
+        self.samples = OrderedDict()
+        self.pending = OrderedDict()
+        self.increments = OrderedDict()
+        self.cleared = set()
+        self.held = 0
+        self.set_dir(dir = dir)
+        self.set_file()
+
+    def set_dir(self, dir=None):
+        try:
+            self.dir = dir if dir else environ['TRANSFER_METRICS_DIR']
+            if not exists(self.dir): makedirs(self.dir, self.perm)
+        except Exception as e:
+            if self.verbose: print("METRICS> %r" % e)
+            self.dir = None
+
+    def set_file(self):
+        name = "_".join([value for value in (self.prefix, self.observatory, self.mode) if value])
+        self.file = join(self.dir, "%s.prom" % name) if self.dir else None
+        if self.verbose: print("METRICS> file=%r" % self.file)
+
+    def set(self, name=None, value=None, **labels):
+        if name in self.types and value is not None:
+            key = (name, self.get_labels(labels = labels))
+            with self.lock:
+                if self.samples.get(key) != value:
+                    self.samples[key] = self.pending[key] = value
+                    self.cleared.discard(key)
+                    if not self.held: self.write()
+
+    def clear(self, name=None, **labels):
+        # a gauge that no longer applies leaves the file, rather than keep its last value
+        key = (name, self.get_labels(labels = labels))
+        with self.lock:
+            self.samples.pop(key, None)
+            self.pending.pop(key, None)
+            self.cleared.add(key)
+            if not self.held: self.write()
+
+    def inc(self, name=None, value=1, **labels):
+        if name in self.types and value:
+            with self.lock:
+                key = (name, self.get_labels(labels = labels))
+                self.samples[key] = self.samples.get(key, 0) + value
+                # a counter carries its increment, so the counts of other processes add up in the file
+                self.increments[key] = self.increments.get(key, 0) + value
+                if not self.held: self.write()
+
+    @contextmanager
+    def batch(self):
+        # samples set inside the block go to the file in one write when it ends
+        with self.lock: self.held += 1
+        try: yield self
+        finally:
+            with self.lock:
+                self.held -= 1
+                if not self.held and (self.pending or self.increments or self.cleared): self.write()
+
+    def set_state(self, name=None, state=None, states=None, **labels):
+        for value in states if states else []: self.set(name, 1 if value == state else 0, state = value, **labels)
+
+    def get_labels(self, labels=None):
+        labels = OrderedDict([('observatory', self.observatory), ('mode', self.mode)] + sorted(labels.items() if labels else []))
+        return tuple([(key, str(value)) for key, value in labels.items() if value is not None])
+
+    def get_lines(self, samples=None):
+        lines = []
+        for name, (type, help) in self.types.items():
+            named = [(labels, value) for (sample, labels), value in samples.items() if sample == name]
+            if named:
+                lines += ["# HELP %s_%s %s" % (self.prefix, name, help), "# TYPE %s_%s %s" % (self.prefix, name, type)]
+                for labels, value in named:
+                    labels = ",".join(['%s="%s"' % (key, value.replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels])
+                    lines.append("%s_%s{%s} %s" % (self.prefix, name, labels, value))
+        return lines
+
+    def get_samples(self):
+        samples = OrderedDict()
+        if exists(self.file):
+            with open(self.file) as file:
+                for line in file:
+                    match = self.line_pattern.match(line.rstrip("\n"))
+                    labels = tuple([(key, re.sub(r'\\(.)', r'\1', value)) for key, value in self.label_pattern.findall(match.group(2))]) if match else None
+                    # samples keyed by MJD or by rsync stream are left over from older versions, so let them drop out
+                    if match and match.group(1) in self.types and 'mjd' not in dict(labels) and 'stream' not in dict(labels): samples[(match.group(1), labels)] = self.get_value(text = match.group(3))
+        return samples
+
+    def get_value(self, text=None):
+        try: return int(text)
+        except ValueError: return float(text)
+
+    def write(self):
+        if self.file:
+            # other processes of this observatory and mode share the file, so merge into it under a lock
+            temp = "%s.%r.tmp" % (self.file, getpid())
+            try:
+                with open(self.file + '.lock', 'w') as lock:
+                    flock(lock, LOCK_EX)
+                    samples = self.get_samples()
+                    samples.update(self.pending)
+                    for key in self.cleared: samples.pop(key, None)
+                    for key, value in self.increments.items(): samples[key] = samples.get(key, 0) + value
+                    samples[('write_timestamp_seconds', self.get_labels())] = round(time(), 3)
+                    # node_exporter may read at any moment, so write aside and rename over the old file
+                    with open(temp, 'w') as file: file.write("\n".join(self.get_lines(samples = samples)) + "\n")
+                    replace(temp, self.file)
+                self.pending.clear()
+                self.increments.clear()
+                self.cleared.clear()
+            except Exception as e:
+                # a failed write keeps its pending samples and increments, so the next write carries them
+                print("METRICS> %r" % e)
+
@@ -4,6 +4,7 @@ from os.path import join, exists, isdir, relpath, split, getmtime, islink, lexis
 from grp import getgrnam
 from collections import OrderedDict
 from json import load, dump, dumps
+from copy import copy
 
 class Mirror:
 
@@ -12,8 +13,9 @@ class Mirror:
     staging = 'mirror_%s' % label
     group = 'sdss'
     
-    def __init__(self, options=None, staging=None, observatory=None, mode=None, process=None, logger=None, log_dir=None, identifier=None, location=None, mjd=None, save_manifest=None, manifest_only=None, dryrun=None, verbose=None, sync = None):
+    def __init__(self, options=None, staging=None, observatory=None, mode=None, process=None, logger=None, log_dir=None, identifier=None, location=None, mjd=None, save_manifest=None, manifest_only=None, dryrun=None, verbose=None, sync = None, globus = None, metrics = None):
         self.staging = staging
+        self.metrics = metrics
         self.mode = mode
         self.process = process
         self.logger = logger
@@ -37,7 +39,7 @@ class Mirror:
         self.set_file()
         self.set_logger()
         self.set_options(sync='mtime', preserve_mtime=True, fail_on_quota_errors=True, verify=True, encrypt=True)
-        self.set_globus()
+        self.set_globus(globus = globus)
     
     def set_stage(self, observatory=None, mode=None):
         if observatory is None and mode is None and self.identifier is None and self.location is not None:
@@ -109,9 +111,10 @@ class Mirror:
                 else:
                     self.file[file] = join(self.dir[file], "%s.%s.json" % (prefix, self.identifier))
 
-    def set_globus(self):
+    def set_globus(self, globus = None):
         if not self.manifest_only:
-            self.globus = Globus(logger = self.logger, verbose = self.verbose)
+            self.globus = copy(globus) if globus else Globus(logger = self.logger, metrics = self.metrics, verbose = self.verbose)
+            self.globus.logger, self.globus.metrics = (self.logger, self.metrics)
             self.ready = self.globus.ready
             self.set_active_user()
             self.info_message(message = "ready=%r for active user=%r" % (self.ready, self.active_user))
@@ -419,6 +422,21 @@ class Mirror:
             self.transfer = None
             self.info_message(message = "skipping transfer (save manifest only)")
 
+    def resume_transfer(self, task_id=None):
+        self.transfer = None
+        if task_id and not self.manifest_only and self.globus and self.globus.client:
+            try: task = self.globus.client.get_task(task_id)
+            except Exception as e:
+                self.error_message(message = "Cannot resume task_id=%r: %r" % (task_id, e))
+                task = None
+            if task and task["status"] in ("ACTIVE", "SUCCEEDED"):
+                self.globus.task_id, self.globus.task = (task_id, task)
+                self.transfer = task
+                self.info_message(message = "Resume task_id=%r with status=%s" % (task_id, task["status"]))
+            elif task:
+                self.info_message(message = "Resubmit after task_id=%r with status=%s" % (task_id, task["status"]))
+                if self.metrics is not None: self.metrics.inc("retries_total", stage = self.stage)
+
     def set_options(self, label=None, sync=None, preserve_mtime=False, fail_on_quota_errors=False, verify=False, delete=False, encrypt=False):
         self.options = {}
         option_label = "transfer_mirror"#transfer.lco.lvm.mirror.61215
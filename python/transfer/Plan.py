@@ -0,0 +1,104 @@
+from os import walk, stat
+from os.path import join, exists, relpath
+from json import load
+from glob import iglob
+from datetime import datetime
+from statistics import median
+from collections import OrderedDict
+
+class Plan:
+
+    timed = ['download', 'copy', 'mirror', 'backup']
+    recent = 20
+    time_format = '%Y-%m-%dT%H:%M:%S'
+
+    def __init__(self, staging=None, mjd=None, histories=None, stage_after=None, verbose=False):
+        self.staging = staging
+        self.mjd = mjd
+        self.verbose = verbose
+        self.volume = OrderedDict()
+        self.set_throughput(histories = histories, stage_after = stage_after)
+
+    def add(self, section=None, stage=None, files=None):
+        files = files if files else {}
+        self.volume.setdefault(section, OrderedDict())[stage] = {'files': len(files), 'bytes': sum(files.values())}
+
+    def get_listing(self, dir=None):
+        listing = {}
+        if dir and exists(dir):
+            for root, dirs, files in walk(dir):
+                for file in files:
+                    try: listing[relpath(join(root, file), dir)] = stat(join(root, file)).st_size
+                    except OSError: continue
+        return listing
+
+    def get_changed(self, source=None, destination=None):
+        return {file: size for file, size in source.items() if destination.get(file) != size} if source else {}
+
+    def set_throughput(self, histories=None, stage_after=None):
+        rates = {}
+        for index, (mjd, status) in enumerate(sorted(histories.items(), reverse=True) if histories else []):
+            if mjd == self.mjd: continue
+            if index > 3 * self.recent: break
+            # prefer the rate recorded with the stage, else derive it from the history stamps and summaries
+            recorded = {stage: status[stage]['rate'] * 1e6 for stage in self.timed if status.get(stage) and status[stage].get('status') == 'success' and status[stage].get('rate')}
+            durations = {stage: duration for stage, duration in self.get_durations(status = status, stage_after = stage_after).items() if stage not in recorded}
+            nbytes = self.get_bytes(mjd = mjd) if durations else None
+            for stage, duration in durations.items() if nbytes else []:
+                if duration > 0: recorded[stage] = nbytes / duration
+            for stage, rate in recorded.items():
+                if len(rates.setdefault(stage, [])) < self.recent: rates[stage].append(rate)
+        self.throughput = {stage: median(values) for stage, values in rates.items() if values}
+        if self.verbose: print("PLAN> throughput [MB/s] %r" % {stage: round(rate / 1e6, 1) for stage, rate in self.throughput.items()})
+
+    def get_durations(self, status=None, stage_after=None):
+        durations, end = ({}, {})
+        history = status.get('history', []) if status else []
+        for stage, after in stage_after.items() if stage_after else []:
+            stops = [entry['stamp'] for entry in history if entry['stage'] == stage and entry['status'] == 'success']
+            stop = max(stops) if stops else None
+            starts = [entry['stamp'] for entry in history if stop and entry['stage'] == stage and entry['status'] == 'incomplete' and entry['stamp'] <= stop]
+            if starts:
+                # a stage starts once the run and the stages it waits on have started and finished
+                start = max([max(starts)] + [end[dependency] for dependency in after if dependency in end and max(starts) <= end[dependency] <= stop])
+                end[stage] = stop
+                durations[stage] = (datetime.strptime(stop, self.time_format) - datetime.strptime(start, self.time_format)).total_seconds()
+        return durations
+
+    def get_bytes(self, mjd=None):
+        nbytes = 0
+        for file in iglob(join(self.staging, 'summaries', str(mjd), '*-%s.json' % mjd)) if self.staging else []:
+            try:
+                with open(file) as stats: nbytes += sum([stat['size'] for stat in load(stats) if not stat.get('is_symlink')])
+            except (OSError, ValueError, KeyError, TypeError): continue
+        return nbytes
+
+    def get_total(self):
+        total = OrderedDict()
+        for section, stages in self.volume.items():
+            for stage, volume in stages.items():
+                total.setdefault(stage, {'files': 0, 'bytes': 0})
+                total[stage]['files'] += volume['files']
+                total[stage]['bytes'] += volume['bytes']
+        for stage, volume in total.items(): volume['seconds'] = self.get_seconds(stage = stage, nbytes = volume['bytes'])
+        return total
+
+    def get_seconds(self, stage=None, nbytes=None):
+        return nbytes / self.throughput[stage] if stage in self.timed and stage in self.throughput else None
+
+    def get_lines(self):
+        lines = ["PLAN> MJD=%r" % self.mjd, "%-12s %-10s %8s %14s %9s %10s" % ('section', 'stage', 'files', 'bytes', 'MB/s', 'est[min]')]
+        for section, stages in self.volume.items():
+            for stage, volume in stages.items(): lines.append(self.get_line(section = section, stage = stage, volume = volume))
+        total = self.get_total()
+        for stage, volume in total.items(): lines.append(self.get_line(section = 'TOTAL', stage = stage, volume = volume))
+        seconds = [volume['seconds'] for volume in total.values() if volume['seconds'] is not None]
+        lines.append("PLAN> MJD=%r estimate %.1f min for stages with throughput history (tar and zstd are timed within backup)" % (self.mjd, sum(seconds) / 60))
+        return lines
+
+    def get_line(self, section=None, stage=None, volume=None):
+        rate = self.throughput.get(stage) if stage in self.timed else None
+        seconds = self.get_seconds(stage = stage, nbytes = volume['bytes'])
+        return "%-12s %-10s %8d %14d %9s %10s" % (section[:12], stage, volume['files'], volume['bytes'], "%.1f" % (rate / 1e6) if rate else '-', "%.1f" % (seconds / 60) if seconds is not None else '-')
+
+    def print(self): print("\n".join(self.get_lines()))
@@ -1,49 +1,113 @@
-from math import log10
-from os import environ, getpid, makedirs, unlink
-from os.path import join, exists
+from os import makedirs, read, close, fstat, wait4, WNOHANG, waitstatus_to_exitcode
+from os.path import exists
 from sys import exit
-from subprocess import Popen, STDOUT
+from subprocess import Popen, PIPE, STDOUT
 from shlex import split
-from tempfile import TemporaryFile
-from time import time, sleep
+from selectors import DefaultSelector, EVENT_READ
+from collections import deque
+from time import time, sleep, monotonic
+from threading import local
+from transfer.Lock import Lock
+try: from os import pidfd_open
+except ImportError: pidfd_open = None
 
 class Process:
 
-    def __init__(self, program=None, mjd=None, logger=None, verbose=False):
+    timeout = 500000
+    limit = 4
+    tail = 10000
+    poll_interval = 0.1
+
+    # results of the last run are per thread, so stages may share one Process
+    status = property(lambda self: getattr(self.local, 'status', None), lambda self, value: setattr(self.local, 'status', value))
+    out = property(lambda self: getattr(self.local, 'out', None), lambda self, value: setattr(self.local, 'out', value))
+    err = property(lambda self: getattr(self.local, 'err', None), lambda self, value: setattr(self.local, 'err', value))
+    abort = property(lambda self: getattr(self.local, 'abort', None), lambda self, value: setattr(self.local, 'abort', value))
+
+    def __init__(self, program=None, mjd=None, logger=None, limit=None, trace=None, locking=True, verbose=False):
         self.program = program if program else "transfer"
         self.mjd = mjd
         self.logger = logger
+        self.limit = limit if limit else self.limit
+        self.trace = trace
+        self.locking = locking
         self.verbose = verbose
+        self.local = local()
         self.set_ready()
 
-    def run(self, command=None, batch=None, ignore_error=False):
+    def run(self, command=None, batch=None, ignore_error=False, timeout=None, callback=None, tail=None, cwd=None, budget=None):
+        self.status, self.out, self.err, self.abort = (None, None, None, None)
+        if command:
+            command = self.run_concurrent(commands=[Command(command=command, batch=batch, timeout=timeout, callback=callback, tail=tail if tail else self.tail, cwd=cwd)], limit=1, ignore_error=ignore_error, budget=budget)[0]
+            self.status, self.out, self.err, self.abort = (command.status, command.out, command.err, command.abort)
+            if self.abort and timeout is None: exit(self.status)
+
+    def lines(self, command=None, batch=None, ignore_error=False, timeout=None, tail=None, cwd=None):
         self.status, self.out, self.err, self.abort = (None, None, None, None)
         if command:
-            if self.logger is not None: self.logger.debug(command)
-            stdin = open(batch) if batch and exists(batch) else None
-            stdout, stderr = (TemporaryFile(), TemporaryFile())
-            proc = self.open(command=command, stdin=stdin, stdout=stdout, stderr=stderr)
-            tstart = time()
-            while proc.poll() is None:
-                elapsed = time() - tstart
-                if elapsed > 500000:
-                    self.abort = "Process still running after more than 5 days!"
-                    proc.kill()
-                    break
-                self.sleep(seconds=10**(int(log10(elapsed))-1))
-            stdout.seek(0)
-            stderr.seek(0)
-            self.status, self.out, self.err = (proc.returncode, stdout.read().decode(), stderr.read().decode())
-            stdout.close()
-            stderr.close()
-            if self.logger is not None:
-                if self.status:
-                    (self.logger.debug if ignore_error else self.logger.error)("command return code %r" % self.status)
-                    if len(self.out) > 0: self.logger.debug("STDOUT:\n" + self.out)
-                    if len(self.err) > 0: self.logger.debug("STDERR:\n" + self.err)
-                if self.status and self.abort: self.logger.critical(self.abort)
-            if self.abort: exit(self.status)
-    
+            buffer = deque()
+            command = Command(command=command, batch=batch, timeout=timeout, callback=buffer.append, tail=tail if tail else self.tail, cwd=cwd)
+            for running in self.execute(commands=[command], limit=1, ignore_error=ignore_error):
+                while buffer: yield buffer.popleft()
+            while buffer: yield buffer.popleft()
+            self.status, self.out, self.err, self.abort = (command.status, command.out, command.err, command.abort)
+            if self.abort and timeout is None: exit(self.status)
+
+    def run_concurrent(self, commands=None, limit=None, ignore_error=False, budget=None):
+        commands = [command if isinstance(command, Command) else Command(command=command, tail=self.tail) for command in commands] if commands else []
+        for running in self.execute(commands=commands, limit=limit, ignore_error=ignore_error, budget=budget): pass
+        return commands
+
+    def execute(self, commands=None, limit=None, ignore_error=False, budget=None):
+        pending, running = (list(commands) if commands else [], [])
+        limit = limit if limit else self.limit
+        selector = DefaultSelector()
+        try:
+            while pending or running:
+                # a callable limit is asked again before every start, so a tuner can grow or shrink the live queue
+                while pending and len(running) < (limit() if callable(limit) else limit):
+                    # a budget shared between threads caps the commands they run at once
+                    if budget is not None and not budget.acquire(blocking=not running, timeout=1 if not running else None): break
+                    command = pending.pop(0)
+                    command.budget = budget
+                    # a command takes the lowest free worker slot, so progress reports name the worker rather than the batch
+                    command.slot = min(set(range(len(running) + 1)) - set([other.slot for other in running]))
+                    if self.logger is not None: self.logger.debug(command.command)
+                    command.start(selector=selector, timeout=command.timeout if command.timeout else self.timeout)
+                    running.append(command)
+                if not running: continue
+                wait = min([command.deadline for command in running]) - monotonic()
+                if any([command.pidfd is None for command in running]) or (budget is not None and pending): wait = min(wait, self.poll_interval)
+                for key, mask in selector.select(timeout=max(wait, 0)): key.data[0].handle(selector=selector, fileobj=key.fileobj, name=key.data[1])
+                for command in running:
+                    if not command.done() and monotonic() > command.deadline:
+                        command.abort = "Process still running after more than %r seconds!" % (command.deadline - command.tstart)
+                        command.proc.kill()
+                    command.reap(selector=selector)
+                for command in [command for command in running if command.done()]:
+                    running.remove(command)
+                    command.release()
+                    self.report(command=command, ignore_error=ignore_error or command.retries > 0)
+                    if self.trace: self.trace.append(entry=command.get_trace(program=self.program, mjd=self.mjd))
+                    if command.status and command.retries > 0 and not command.abort:
+                        if self.logger is not None: self.logger.warning("Requeue after return code %r: %s" % (command.status, command.command))
+                        command.reset()
+                        pending.append(command)
+                yield running
+        finally:
+            for command in running:
+                if command.proc and command.proc.poll() is None: command.proc.kill()
+                command.release()
+            selector.close()
+
+    def report(self, command=None, ignore_error=False):
+        if self.logger is not None and command:
+            if command.status:
+                (self.logger.debug if ignore_error else self.logger.error)("command return code %r" % command.status)
+                if command.out: self.logger.debug("STDOUT:\n" + command.out)
+                if command.err: self.logger.debug("STDERR:\n" + command.err)
+            if command.status and command.abort: self.logger.critical(command.abort)
+
     def sleep(self, seconds=None, minutes=None):
         seconds = (seconds if seconds else 0) + (minutes * 60 if minutes else 0)
         sleep(seconds if seconds > 1 else 1)
@@ -58,43 +122,128 @@ class Process:
             makedirs(path, mode)
             if self.verbose and not silent: print("PROCESS> CREATE: %r" % path)
 
-    def set_pid_file(self):
-        try:
-            pid_dir = join('/tmp',environ['USER'],self.program)
-            self.mkdir(pid_dir)
-            self.pid_file = join(pid_dir, "%r.pid" % int(self.mjd)) if pid_dir and self.mjd else None
-        except Exception as e:
-            print("PROCESS>: %r" % e)
-            self.pid_file = None
-    
-    def set_pid_from_file(self):
-        self.pid = None
-        if self.pid_file and exists(self.pid_file):
-            with open(self.pid_file,'r') as lines:
-                for line in lines:
-                    try:
-                        self.pid = int(line.strip())
-                        break
-                    except: pass
-
-    def pid_in_use(self):
-        pid_in_use = False
-        if self.pid:
-            self.run("ps -o command= %r" % self.pid, ignore_error=True)
-            pid_in_use = True if self.out and self.program in self.out else None
-            if pid_in_use is None and self.pid_file and exists(self.pid_file) : unlink(self.pid_file)
-        if pid_in_use and self.verbose: print("PROCESS> Found running pid in %r" % self.pid_file)
-        elif self.pid_file:
-            if self.verbose: print("PROCESS> Adding new pid in %r" % self.pid_file)
-            with open(self.pid_file,'w') as file: file.write("%r\n" % getpid())
-        return pid_in_use
-
     def set_ready(self):
         if self.verbose: print("PROCESS> Checking for running instance of %s" % self.program)
         self.ready = False
-        self.set_pid_file()
-        self.set_pid_from_file()
-        self.ready = not self.pid_in_use()
+        self.lock = Lock(program = self.program, mjd = int(self.mjd) if self.mjd else None, verbose = self.verbose) if self.locking and self.mjd else None
+        self.ready = self.lock.acquire() if self.lock else True
+        self.pid = self.lock.pid if self.lock else None
+        if not self.ready and self.verbose: print("PROCESS> Found running pid %r in %r" % (self.pid, self.lock.file))
+
+
+class Command:
+
+    chunk_size = 65536
+
+    def __init__(self, command=None, batch=None, outfile=None, timeout=None, callback=None, tail=None, cwd=None, retries=0, progress=False):
+        self.command = command
+        self.batch = batch
+        self.outfile = outfile
+        self.timeout = timeout
+        self.callback = callback
+        self.cwd = cwd
+        self.retries = retries
+        self.progress = progress
+        self.budget = self.slot = None
+        self.lines = {'out': deque(maxlen=tail), 'err': deque(maxlen=tail)}
+        self.reset(retry=False)
+
+    def reset(self, retry=True):
+        if retry: self.retries -= 1
+        self.proc = self.pidfd = None
+        self.status, self.out, self.err, self.abort = (None, None, None, None)
+        for lines in self.lines.values(): lines.clear()
+        self.partial = {'out': b'', 'err': b''}
+        self.nbytes = {'out': 0, 'err': 0}
+        self.pipes = set()
+        self.rusage = None
+
+    def start(self, selector=None, timeout=None):
+        self.tstart = monotonic()
+        self.stamp = time()
+        self.deadline = self.tstart + timeout
+        stdin = open(self.batch) if self.batch and exists(self.batch) else None
+        # a progress meter redraws its line with carriage returns, so stderr joins it to keep the order of the messages
+        stdout, stderr = (self.outfile, STDOUT) if self.outfile else (PIPE, STDOUT) if self.progress else (PIPE, PIPE)
+        try: self.proc = Popen(split(str(self.command)), stdin=stdin, stdout=stdout, stderr=stderr, cwd=self.cwd)
+        except OSError as e:
+            self.status, self.out, self.err = (127, '', "%r" % e)
+            return
+        finally:
+            if stdin: stdin.close()
+        pipes = {name: pipe for name, pipe in (('out', self.proc.stdout), ('err', self.proc.stderr)) if pipe}
+        for name, pipe in pipes.items():
+            selector.register(pipe, EVENT_READ, (self, name))
+            self.pipes.add(name)
+        if pidfd_open:
+            try:
+                self.pidfd = pidfd_open(self.proc.pid)
+                selector.register(self.pidfd, EVENT_READ, (self, 'exit'))
+            except OSError: self.pidfd = None
+
+    def handle(self, selector=None, fileobj=None, name=None):
+        if name == 'exit':
+            selector.unregister(fileobj)
+            close(self.pidfd)
+            self.pidfd = None
+            self.wait()
+        else:
+            chunk = read(fileobj.fileno(), self.chunk_size)
+            if chunk: self.feed(name=name, chunk=chunk)
+            else:
+                self.feed(name=name, chunk=None)
+                selector.unregister(fileobj)
+                fileobj.close()
+                self.pipes.discard(name)
+
+    def feed(self, name=None, chunk=None):
+        if chunk:
+            self.nbytes[name] += len(chunk)
+            if self.progress: chunk = chunk.replace(b'\r', b'\n')
+            lines = (self.partial[name] + chunk).split(b'\n')
+            self.partial[name] = lines.pop()
+        else:
+            lines = [self.partial[name]] if self.partial[name] else []
+            self.partial[name] = b''
+        for line in lines:
+            line = line.decode(errors='replace')
+            self.lines[name].append(line)
+            if self.callback and name == 'out': self.callback(line)
+
+    def reap(self, selector=None):
+        if self.proc and self.status is None and not self.pipes:
+            if self.pidfd is None or self.abort: self.wait()
+            if self.proc.returncode is not None:
+                self.tend = monotonic()
+                if self.pidfd is not None:
+                    selector.unregister(self.pidfd)
+                    close(self.pidfd)
+                    self.pidfd = None
+                self.status = self.proc.returncode
+                self.out, self.err = ["".join([line + "\n" for line in self.lines[name]]) for name in ('out', 'err')]
+
+    def wait(self):
+        if self.proc.returncode is None:
+            try: pid, status, self.rusage = wait4(self.proc.pid, WNOHANG)
+            except ChildProcessError: pid = self.proc.poll()
+            else:
+                if pid: self.proc.returncode = waitstatus_to_exitcode(status)
 
+    def done(self): return self.status is not None
 
+    def release(self):
+        if self.budget is not None:
+            self.budget.release()
+            self.budget = None
 
+    def get_trace(self, program=None, mjd=None):
+        trace = {'program': program, 'mjd': mjd, 'argv': split(str(self.command)), 'stamp': self.stamp, 'status': self.status, 'abort': self.abort}
+        trace['wall'] = round(self.tend - self.tstart, 6) if self.proc else 0.0
+        trace['user'] = round(self.rusage.ru_utime, 6) if self.rusage else None
+        trace['sys'] = round(self.rusage.ru_stime, 6) if self.rusage else None
+        trace['maxrss'] = self.rusage.ru_maxrss if self.rusage else None
+        trace['bytes'] = dict(self.nbytes)
+        if self.outfile:
+            try: trace['bytes']['out'] = fstat(self.outfile.fileno()).st_size
+            except (OSError, ValueError): pass
+        return trace
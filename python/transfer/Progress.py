@@ -0,0 +1,98 @@
+import re
+from time import monotonic
+from collections import OrderedDict
+
+class Progress:
+
+    interval = 60
+    # "  1,234,567  45%   12.34MB/s    0:00:10 (xfr#3, to-chk=10/20)" from rsync --info=progress2
+    pattern = re.compile(r'^\s*([\d,]+)\s+(\d+)%\s+\S+\s+\d+:\d{2}:\d{2}(?:\s+\(xfr#(\d+), \w+-chk=\d+/\d+\))?\s*$')
+    stats = {'Number of regular files transferred': 'files', 'Total transferred file size': 'bytes'}
+
+    def __init__(self, section=None, total=None, labels=None, interval=None, logger=None, metrics=None, verbose=False):
+        self.section = section
+        self.total = total
+        self.labels = labels if labels else {}
+        self.interval = interval if interval else self.interval
+        self.logger = logger
+        self.metrics = metrics
+        self.verbose = verbose
+        self.commands = OrderedDict()
+        self.reported = 0
+        self.tstart = self.treport = monotonic()
+
+    def get_callback(self, command=None, file=None):
+        # batches come and go, so their state is kept per command and reported by the worker slot that runs it
+        self.commands[command] = {'bytes': 0, 'reported': 0, 'percent': 0, 'files': 0, 'tstart': None, 'done': False, 'file': file}
+        return lambda line: self.feed(command = command, line = line)
+
+    def feed(self, command=None, line=None):
+        match = self.pattern.match(line) if line else None
+        if match: self.update(command = command, match = match)
+        elif line:
+            state = self.commands[command]
+            # the file names and the stats2 summary still go to the stream log
+            if state['file']: state['file'].write(line + "\n")
+            name, sep, value = line.partition(': ')
+            if name in self.stats:
+                try: state[self.stats[name]] = int(value.split(' ')[0].replace(',', ''))
+                except ValueError: pass
+                state['done'] = True
+        if monotonic() - self.treport >= self.interval: self.report()
+
+    def update(self, command=None, match=None):
+        state = self.commands[command]
+        nbytes = int(match.group(1).replace(',', ''))
+        # a retried rsync counts its bytes from zero again
+        if nbytes < state['bytes']: state['reported'] = 0
+        # a requeued batch starts over, so the stats of its failed attempt go
+        if state['tstart'] is None or state['done']: state['tstart'], state['done'], state['files'] = (monotonic(), False, 0)
+        state['bytes'], state['percent'] = (nbytes, int(match.group(2)))
+        if match.group(3): state['files'] = int(match.group(3))
+
+    def get_eta(self, seconds=None): return "%d:%02d:%02d" % (seconds // 3600, seconds % 3600 // 60, seconds % 60) if seconds is not None else "?"
+
+    def report(self, final=False):
+        now = monotonic()
+        seconds = now - self.treport
+        nbytes = files = 0
+        for command, state in self.commands.items():
+            # a stream that exited with an error is retried or rerun, so its files and bytes count there
+            if state['tstart'] is None or command.status not in (None, 0): continue
+            nbytes, files = (nbytes + state['bytes'], files + state['files'])
+            if not final and not state['done'] and command.status is None:
+                rate = max(0, state['bytes'] - state['reported']) / seconds if seconds else 0.0
+                elapsed = now - state['tstart']
+                eta = elapsed * (100 - state['percent']) / state['percent'] if 0 < state['percent'] < 100 else None
+                self.info_message("%s stream %r: %.1f MB/s, %r files, %.2f GB, %r%%, ETA %s" % (self.section, command.slot, rate / 1e6, state['files'], state['bytes'] / 1e9, state['percent'], self.get_eta(seconds = eta)))
+            state['reported'] = state['bytes']
+        if final:
+            elapsed = now - self.tstart
+            rate = nbytes / elapsed if elapsed else 0.0
+            eta = None
+        else:
+            rate = max(0, nbytes - self.reported) / seconds if seconds else 0.0
+            eta = max(0, self.total - nbytes) / rate if self.total and rate else None
+        self.info_message("%s %s: %.1f MB/s, %r files, %.2f GB%s%s" % (self.section, "done" if final else "all streams", rate / 1e6, files, nbytes / 1e9, " of %.2f GB" % (self.total / 1e9) if self.total else "", "" if final else ", ETA %s" % self.get_eta(seconds = eta)))
+        self.set_metrics(rate = rate, files = files, nbytes = nbytes, eta = eta, final = final)
+        self.reported, self.treport = (nbytes, now)
+
+    def set_metrics(self, rate=None, files=None, nbytes=None, eta=None, final=False):
+        if self.metrics is not None:
+            with self.metrics.batch():
+                self.metrics.set('rsync_rate_bytes_per_second', round(rate), **self.labels)
+                self.metrics.set('rsync_files_transferred', files, **self.labels)
+                self.metrics.set('rsync_bytes_transferred', nbytes, **self.labels)
+                # once the section is done, or its ETA is unknown, the last estimate leaves the file
+                if final or eta is None: self.metrics.clear('rsync_eta_seconds', **self.labels)
+                else: self.metrics.set('rsync_eta_seconds', round(eta), **self.labels)
+
+    def close(self):
+        for state in self.commands.values():
+            try: state['file'].close()
+            except: pass
+
+    def info_message(self, message=None):
+        if message:
+            if self.logger: self.logger.info(message)
+            if self.verbose: print("PROGRESS> %s" % message)
@@ -0,0 +1,69 @@
+from os import scandir
+from os.path import join, basename
+import re
+import gzip
+
+class Reconcile:
+
+    presets = {'ircam': {'log': 'irsc.log.gz', 'pattern': r'(cR\d{6}\.fit)(\.gz|)\s*'}}
+
+    def __init__(self, method=None, log=None, pattern=None, mjd=None, logger=None, verbose=False):
+        preset = self.presets.get(method, {})
+        self.mjd = mjd
+        self.logger = logger
+        self.verbose = verbose
+        self.log = (log if log else preset.get('log', '')).format(mjd = mjd)
+        self.set_pattern(pattern = pattern if pattern else preset.get('pattern'))
+
+    def set_pattern(self, pattern=None):
+        try: self.pattern = re.compile(pattern) if pattern else None
+        except re.error as e:
+            self.error_message("Invalid verify_pattern=%r: %r" % (pattern, e))
+            self.pattern = None
+        self.ready = self.pattern is not None and len(self.log) > 0
+
+    def get_key(self, text=None):
+        match = self.pattern.match(text)
+        return (match.group(1) if self.pattern.groups else match.group(0)) if match else None
+
+    def get_log_keys(self, file=None):
+        keys = set()
+        with (gzip.open(file, "rt", errors='replace') if file.endswith('.gz') else open(file, errors='replace')) as lines:
+            for line in lines:
+                key = self.get_key(text = line)
+                if key: keys.add(key)
+        return keys
+
+    def get_disk_keys(self, dir=None):
+        keys = set()
+        with scandir(dir) as entries:
+            for entry in entries:
+                key = self.get_key(text = entry.name) if entry.is_file() else None
+                if key: keys.add(key)
+        return keys
+
+    def check(self, dir=None):
+        self.ok = False
+        if self.ready and dir:
+            name = basename(self.log)
+            log_keys = self.get_log_keys(file = join(dir, self.log))
+            disk_keys = self.get_disk_keys(dir = dir)
+            self.missing_on_disk = sorted(log_keys - disk_keys)
+            self.missing_in_log = sorted(disk_keys - log_keys)
+            self.ok = not self.missing_on_disk and not self.missing_in_log
+            if self.ok: self.info_message("Number of files in %s equals number of files on disk (%r)" % (name, len(log_keys)))
+            else:
+                self.error_message("Files in %s do not match files on disk (%r in log, %r on disk)" % (name, len(log_keys), len(disk_keys)))
+                for file in self.missing_on_disk: self.error_message("    --> Missing %s on disk" % file)
+                for file in self.missing_in_log: self.error_message("    --> Missing %s in %s" % (file, name))
+        return self.ok
+
+    def info_message(self, message=None):
+        if message:
+            if self.logger: self.logger.info(message)
+            if self.verbose: print("RECONCILE> %s" % message)
+
+    def error_message(self, message=None):
+        if message:
+            if self.logger: self.logger.error(message)
+            if self.verbose: print("RECONCILE> %s" % message)
@@ -0,0 +1,105 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from collections import OrderedDict
+
+class Scheduler:
+
+    workers = 4
+
+    def __init__(self, workers=None, logger=None, metrics=None, labels=None, verbose=None):
+        self.workers = workers if workers else self.workers
+        self.logger = logger
+        self.metrics = metrics
+        self.labels = labels if labels else {}
+        self.verbose = verbose
+        self.stages = OrderedDict()
+        self.nodes = OrderedDict()
+
+    def add_stage(self, stage=None, run=None, prepare=None, finalize=None, on_done=None, after=None, workers=None):
+        if stage and run:
+            self.stages[stage] = {'run': run, 'prepare': prepare, 'finalize': finalize, 'on_done': on_done, 'after': after if after else [], 'workers': workers if workers else self.workers, 'prepared': None, 'running': 0, 'done': False}
+
+    def set_nodes(self, sections=None):
+        self.nodes = OrderedDict()
+        for stage, info in self.stages.items():
+            for section in sections if sections else []:
+                after = [(section, dependency) for dependency in info['after'] if dependency in self.stages]
+                self.nodes[(section, stage)] = {'section': section, 'stage': stage, 'after': after, 'status': None}
+            if info['finalize']:
+                after = [key for key in self.nodes if key[1] == stage]
+                self.nodes[(None, stage)] = {'section': None, 'stage': stage, 'after': after, 'status': None}
+        if self.verbose: print("SCHEDULER> %r nodes for stages=%r" % (len(self.nodes), list(self.stages)))
+
+    def run(self):
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while any([node['status'] is None for node in self.nodes.values()]) or futures:
+                for key, node in self.nodes.items():
+                    if node['status'] is not None or key in futures.values(): continue
+                    after = [self.nodes[dependency]['status'] for dependency in node['after']]
+                    if None in after or 'running' in after: continue
+                    info = self.stages[node['stage']]
+                    if node['section'] and any([status != 'success' for status in after]):
+                        node['status'] = 'skip'
+                        self.info_message("Skip %s for section=%r after upstream failure" % (node['stage'], node['section']))
+                        continue
+                    if info['prepared'] is None: info['prepared'] = self.prepare(stage=node['stage'])
+                    if not info['prepared']:
+                        node['status'] = 'failure'
+                        continue
+                    if len(futures) >= self.workers or info['running'] >= info['workers']: continue
+                    run = info['run'] if node['section'] else info['finalize']
+                    node['status'] = 'running'
+                    info['running'] += 1
+                    futures[executor.submit(self.execute, run, node)] = key
+                if futures:
+                    done, pending = wait(list(futures), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        node = self.nodes[futures.pop(future)]
+                        node['status'] = 'success' if future.result() else 'failure'
+                        self.stages[node['stage']]['running'] -= 1
+                self.set_done()
+                self.set_queue()
+        self.set_done()
+        self.set_queue()
+
+    def prepare(self, stage=None):
+        prepare = self.stages[stage]['prepare']
+        try: prepared = prepare() if prepare else True
+        except Exception as e:
+            self.error_message("Failed to prepare %s: %r" % (stage, e))
+            prepared = False
+        return prepared is not False
+
+    def execute(self, run, node):
+        try: return run(node['section']) if node['section'] else run(self.get_status(stage=node['stage']))
+        except Exception as e:
+            self.error_message("%s failed for section=%r: %r" % (node['stage'], node['section'], e))
+            return False
+
+    def get_status(self, stage=None):
+        return OrderedDict([(node['section'], node['status']) for node in self.nodes.values() if node['stage'] == stage and node['section']])
+
+    def set_queue(self):
+        if self.metrics is not None:
+            for stage in self.stages:
+                depth = len([node for node in self.nodes.values() if node['stage'] == stage and node['status'] in (None, 'running')])
+                self.metrics.set('queue_depth', depth, stage = stage, **self.labels)
+
+    def set_done(self):
+        for stage, info in self.stages.items():
+            statuses = [node['status'] for node in self.nodes.values() if node['stage'] == stage]
+            if not info['done'] and all([status in ('success', 'failure', 'skip') for status in statuses]):
+                info['done'] = True
+                status = 'failure' if 'failure' in statuses else 'incomplete' if 'skip' in statuses else 'success'
+                self.info_message("Stage %s finished with status=%s" % (stage, status))
+                if info['on_done']: info['on_done'](stage, status)
+
+    def info_message(self, message = None):
+        if message:
+            if self.logger: self.logger.info("SCHEDULER> %s" % message)
+            if self.verbose: print("SCHEDULER> %s" % message)
+
+    def error_message(self, message = None):
+        if message:
+            if self.logger: self.logger.error("SCHEDULER> %s" % message)
+            if self.verbose: print("SCHEDULER> %s" % message)
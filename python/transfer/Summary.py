@@ -1,5 +1,5 @@
 from os import makedirs, environ, walk
-from os.path import basename, exists, join
+from os.path import basename, dirname, exists, join
 from collections import OrderedDict
 from time import gmtime, strftime
 from datetime import datetime
@@ -9,6 +9,7 @@ from jinja2 import Environment, FileSystemLoader
 from glob import iglob
 from copy import deepcopy
 from pytz import timezone
+from transfer import Lock
 
 
 class Summary:
@@ -19,7 +20,7 @@ class Summary:
     todo_status = "incomplete"
     mode = 0o775
 
-    def __init__(self, staging=None, observatory=None, log_dir = None, mjd=None, logfile=None, verbose=False):
+    def __init__(self, staging=None, observatory=None, log_dir = None, mjd=None, logfile=None, histories=None, verbose=False):
         self.staging = staging
         self.generation = 5 if 'data' in staging else 4
         self.observatory = observatory
@@ -31,7 +32,7 @@ class Summary:
         self.set_indexfile()
         self.set_jsonfile()
         self.set_status()
-        self.set_history()
+        self.set_history(histories = histories)
 
     def export_section(self, directory = None, section = None):
         if section and directory and exists(directory):
@@ -45,11 +46,11 @@ class Summary:
                 mjd_dir = None
             if mjd_dir:
                 self.navajo = timezone('Navajo')
-                self.file = join(mjd_dir, "%s-%r.json" % (section, self.mjd))
+                self.file = section_file = join(mjd_dir, "%s-%r.json" % (section, self.mjd))
                 stats = [self.get_stats(directory = path, files = subfiles) for path, subdirs, subfiles in walk(directory)]
-                if stats and self.file:
+                if stats and section_file:
                     stats = [stat for substats in stats for stat in substats]
-                    with open(self.file, 'w') as file: dump(stats, file, indent=4)
+                    with open(section_file, 'w') as file: dump(stats, file, indent=4)
             else: self.file = None
 
     def get_stats(self, directory=None, files=None):
@@ -70,9 +71,10 @@ class Summary:
                     print(error)
         return stats
 
-    def save(self, stage=None, status=None):
-        self.append_history(stage=stage, status=status)
+    def save(self, stage=None, status=None, metrics=None):
+        self.append_history(stage=stage, status=status, metrics=metrics)
         self.update_jsonfile()
+        self.histories[self.mjd] = self.compressed_history(self.status)
         self.set_indexhtml()
         self.write_indexfile()
     
@@ -90,11 +92,11 @@ class Summary:
         if self.verbose: print("SUMMARY> indexfile=%r" % self.indexfile)
 
     def set_jsonfile(self):
-        self.jsonfile = join(self.staging,self.log_dir,str(self.mjd),'{0:d}_status.json'.format(self.mjd))
+        self.jsonfile = join(self.staging,self.log_dir,str(self.mjd),'{0:d}_status.json'.format(self.mjd)) if self.mjd else None
         if self.verbose: print("SUMMARY> jsonfile=%r" % self.jsonfile)
 
     def set_status(self):
-        if exists(self.jsonfile):
+        if self.jsonfile and exists(self.jsonfile):
             with open(self.jsonfile) as jsonfile: self.status = load(jsonfile)
             self.current_status = deepcopy(self.status)
             if self.logfile: self.status["logfile"] = self.logfile
@@ -102,10 +104,12 @@ class Summary:
             self.status = {"MJD": self.mjd, "history": [], "logfile": self.logfile}
             self.current_status = None
 
-    def append_history(self, stage=None, status=None):
+    def append_history(self, stage=None, status=None, metrics=None):
         timestamp = strftime('%Y-%m-%dT%H:%M:%S',gmtime())
         if status:
-            self.status["history"].append({"stage":stage,"status":status,"stamp":timestamp})
+            history = {"stage":stage,"status":status,"stamp":timestamp}
+            if metrics: history.update(metrics)
+            self.status["history"].append(history)
         else:
             stages = self.stages.items()
             stages_todo = [stage for stage,todo in stages if todo]
@@ -116,10 +120,23 @@ class Summary:
         if self.jsonfile:
             if self.status != self.current_status:
                 if self.verbose: print("SUMMARY> UPDATE %r" % self.jsonfile)
-                with open(self.jsonfile,'w') as jsonfile:
-                    dump(self.status, jsonfile, sort_keys=True, indent=2, separators=(',',': '))
+                with Lock(mjd = self.mjd, section = 'status', dir = dirname(self.jsonfile)):
+                    self.merge_jsonfile()
+                    with open(self.jsonfile,'w') as jsonfile:
+                        dump(self.status, jsonfile, sort_keys=True, indent=2, separators=(',',': '))
+                self.current_status = deepcopy(self.status)
             elif self.verbose: print("SUMMARY> NO CHANGE TO %r" % self.jsonfile)
 
+    def merge_jsonfile(self):
+        if exists(self.jsonfile):
+            try:
+                with open(self.jsonfile) as jsonfile: status = load(jsonfile)
+            except ValueError: status = None
+            if status and status != self.current_status:
+                history = status.get('history', [])
+                history += [entry for entry in self.status['history'] if entry not in history]
+                self.status['history'] = sorted(history, key=lambda x: x["stamp"])
+
     def compressed_history(self, status):
         compressed_history = deepcopy(status)
         for stage in self.stages:
@@ -144,15 +161,17 @@ class Summary:
         return detailed_histories"""
 
     def sorted_histories(self):
-        history = [self.compressed_history(self.status)] + self.history
+        history = [self.compressed_history(self.status)] + [history for mjd, history in self.histories.items() if mjd != self.mjd]
         return sorted(history, key=lambda x: x["MJD"], reverse=True)
 
-    def set_history(self):
-        self.history = []
-        for mjd_dir in iglob(join(self.staging,self.log_dir,'[0-9][0-9][0-9][0-9][0-9]')):
-            jsonfile = join(mjd_dir,'{mjd}_status.json'.format(mjd=basename(mjd_dir)))
-            if exists(jsonfile) and jsonfile != self.jsonfile:
-                with open(jsonfile) as json: self.history.append(self.compressed_history(load(json)))
+    def set_history(self, histories=None):
+        if histories is None:
+            histories = OrderedDict()
+            for mjd_dir in sorted(iglob(join(self.staging,self.log_dir,'[0-9][0-9][0-9][0-9][0-9]'))):
+                jsonfile = join(mjd_dir,'{mjd}_status.json'.format(mjd=basename(mjd_dir)))
+                if exists(jsonfile) and jsonfile != self.jsonfile:
+                    with open(jsonfile) as json: histories[int(basename(mjd_dir))] = self.compressed_history(load(json))
+        self.histories = histories
 
 
 
@@ -164,9 +183,19 @@ class Summary:
         title = title + " Data Transfer Status" if title else " Data Transfer Status"
         histories =  self.sorted_histories()
         #histories =  self.detailed_histories(self.sorted_histories())
-        context = {'title': title, 'stages': self.stages, 'colors': self.colors, 'modified': datetime.utcnow(), 'histories': histories, 'observatory': self.observatory, 'mode': mode, 'generation': self.generation}
+        context = {'title': title, 'stages': self.stages, 'colors': self.colors, 'modified': datetime.utcnow(), 'histories': histories, 'trends': self.get_trends(histories = histories), 'observatory': self.observatory, 'mode': mode, 'generation': self.generation}
         self.indexhtml = self.index_template.render(context) if self.index_template else None
 
+    def get_trends(self, histories=None):
+        trends = OrderedDict([(metric, OrderedDict([(stage, []) for stage in self.stages])) for metric in ['rate', 'duration']])
+        for history in histories if histories else []:
+            for stage in self.stages:
+                entry = history.get(stage)
+                if entry and entry.get('status') == 'success' and entry.get('duration'):
+                    if entry.get('rate') is not None: trends['rate'][stage].append([history['MJD'], entry['rate']])
+                    trends['duration'][stage].append([history['MJD'], round(entry['duration'] / 60, 1)])
+        return trends
+
     def write_indexfile(self):
         if self.indexhtml:
             if self.verbose: print("SUMMARY> WRITE: %r" % self.indexfile)
@@ -1,14 +1,27 @@
-from os import environ, symlink
+from os import environ, symlink, scandir
 from os.path import join, exists, isdir, islink, basename, dirname, expanduser
 from glob import iglob
 from json import loads, dump
+from hashlib import md5
+from heapq import heapify, heapreplace
+from collections import OrderedDict
 from astropy.io.fits import getval
 from shutil import rmtree
+from copy import copy
+from time import time
 from transfer import Remote
+from transfer.Master import Master
+from transfer.Process import Command
+from transfer.Progress import Progress
 
 class Sync:
 
-    def __init__(self, staging=None, from_sas = None, streams=None, perm=None, sync=None, mjd=None, log_dir=None, process=None, logger=None, verbose=None):
+    watch_timeout = 600
+    batch_files = 50
+    batch_bytes = 2000000000
+    retries = 1
+
+    def __init__(self, staging=None, from_sas = None, streams=None, perm=None, sync=None, mjd=None, log_dir=None, process=None, logger=None, metrics=None, budget=None, masters=None, tuner=None, verbose=None):
         self.from_sas = from_sas
         self.staging = staging
         self.streams = streams
@@ -17,7 +30,14 @@ class Sync:
         self.log_dir = log_dir
         self.process = process
         self.logger = logger
+        self.metrics = metrics
+        self.budget = budget
+        self.masters = masters
+        self.tuner = tuner
         self.verbose = verbose
+        self.journal = self.inventory = self.listing = None
+        self.partial = False
+        self.inventories = {}
         self.set_rsync_keywords()
         self.dryrun = ( sync == 'init' )
         self.finalize = ( sync == 'final' )
@@ -79,64 +99,264 @@ class Sync:
             if self.from_sas: command += "{mjd_dir}/ {remote_path}/{mjd}/"
             else: command += "{remote_path}/{mjd}/ {mjd_dir}/"
             command = command.format(**self.cfg)
-            self.process.run(command)
-            if self.process.status != 0: self.ready = False
+            journal = self.journal if not self.dryrun else None
+            if journal and journal.done('rsync'): self.logger.info("Journal shows rsync of %s done [skip]" % self.mjd_dir)
+            else:
+                self.process.run(command, budget=self.budget)
+                if self.process.status != 0: self.ready = False
+                elif journal: journal.record(unit = 'rsync')
 
     def run_multiple_rsync(self):
         if self.ready and self.streams:
-            if self.from_sas: command = "/bin/ls -1 {mjd_dir}"
-            else: command = "{ssh_command} {ssh_config} /bin/ls -1 {path}/{mjd}"
-            if self.cfg['folder']: command += "/{folder}"
-            command = command.format(**self.cfg)
-            self.process.run(command)
-            if len(self.process.out) > 0:
-                files = [file for file in self.process.out.split("\n") if len(file) > 0]
-                streams = []
-                for stream_index in range(self.streams):
-                    self.cfg['stream_index'] = str(stream_index)
-                    stream_files = [files[index] for index in range(len(files)) if index % self.streams == stream_index]
-                    self.cfg['stream_filename'] = stream_filename = "{workdir}/{stage}.{section}.{stream_index}.rsync.txt".format(**self.cfg)
-                    with open(stream_filename,'w') as stream_file: stream_file.write("\n".join(stream_files)+"\n")
-                    command = "rsync {rsync_keywords} --files-from={stream_filename}"
-                    if self.from_sas: command += " {mjd_dir}/"
-                    else: command += " {remote_path}/{mjd}/"
-                    if self.cfg['folder']: command += "{folder}/"
-                    if self.from_sas: command += " {remote_path}/{mjd}/"
-                    else: command += " {mjd_dir}/"
-                    if self.cfg['folder']: command += "{folder}/"
-                    command = command.format(**self.cfg)
-                    stream_log = stream_filename.replace('.txt','.log')
-                    if self.dryrun:
-                        streams.append({'command':command ,'outfile':stream_log})
-                    else:
-                        self.logger.debug(command)
-                        outfile = open(stream_log,'w')
-                        proc = self.process.open(command, stdout=outfile)
-                        streams.append({'proc':proc,'outfile':outfile})
-                        self.process.sleep()
-                if self.dryrun:
-                    stream_file = "{workdir}/{stage}.{section}.rsync.json".format(**self.cfg)
-                    with open(stream_file, 'w') as file: dump(streams, file, indent=4)
-                else:
-                    while any([stream['proc'].poll() is None for stream in streams]):
-                        self.logger.debug("Rsync commands still running, going back to sleep.")
-                        self.process.sleep(minutes=1)
-                    if any([stream['proc'].returncode != 0 for stream in streams]): self.ready = False
-                    for stream in streams:
-                        try: stream['outfile'].close()
-                        except: pass
+            self.set_inventory(maxdepth = None, cached = True)
+            if self.listing is None:
+                self.logger.error("No listing of %s, which exists, so nothing can be downloaded" % self.section)
+                self.ready = False
+                return
+            # a partial listing may miss changed files, so the streams take the whole top level entries
+            sizes = self.get_delta() if self.listing and not self.partial else None
+            sizes = sizes if sizes is not None else self.listing
+            files = list(sizes) if sizes else []
+            # the size and mtime delta decides what to move, the journal only records what landed
+            journal = self.journal if not self.dryrun else None
+            if files:
+                if not self.run_streams(files = files, journal = journal, sizes = sizes): self.ready = False
+            elif sizes is not self.listing: self.logger.info("Local %s matches the remote inventory of %s [skip]" % (self.mjd_dir, self.section))
             else:
                 mjd_dir = "{mjd_dir}" if self.from_sas else "{path}/{mjd}"
                 mjd_dir = mjd_dir.format(**self.cfg)
                 self.logger.info("Directory exists, but no data for %s." % mjd_dir)
 
-    def set_mjd_dir(self, env = None):
+    def get_snapshot(self, dir=None, path=''):
+        snapshot = {}
+        try:
+            with scandir(join(dir, path) if path else dir) as entries:
+                for entry in entries:
+                    name = join(path, entry.name) if path else entry.name
+                    if entry.is_dir(follow_symlinks = False): snapshot.update(self.get_snapshot(dir = dir, path = name))
+                    elif entry.is_file(follow_symlinks = False):
+                        stat = entry.stat(follow_symlinks = False)
+                        snapshot[name] = (stat.st_size, int(stat.st_mtime))
+                    else: snapshot[name] = None
+        except OSError: pass
+        return snapshot
+
+    def get_delta(self):
+        # rsync --times keeps the remote mtime, so a landed file matches the inventory by size and whole seconds
+        local_dir = join(self.mjd_dir, self.cfg['folder']) if self.mjd_dir and self.cfg['folder'] else self.mjd_dir
+        # a push lists its own source, so there is no destination inventory to compare against
+        local = self.get_snapshot(dir = local_dir) if local_dir and not self.from_sas else None
+        if not local or self.inventory is None: return None
+        delta = OrderedDict()
+        for file, (size, mtime) in sorted(self.inventory.items()):
+            if local.get(file) != (size, int(float(mtime))): delta[file] = size
+        # links and empty directories are not in the inventory of files, so bring over the missing top level ones whole
+        tops, local_tops = (set([file.split('/', 1)[0] for file in self.inventory]), set([name.split('/', 1)[0] for name in local]))
+        for top in self.listing:
+            if top not in tops and top not in local_tops: delta[top] = 0
+        self.logger.info("Delta of %r of %r remote files [%.2f GB] against %r local files in %s" % (len(delta), len(self.inventory), sum(delta.values()) / 1e9, len(local), local_dir))
+        return delta
+
+    def run_watch_rsync(self):
+        landed = 0
+        if self.ready and self.streams and not self.dryrun:
+            previous = self.inventory
+            self.set_inventory()
+            if self.inventory and previous:
+                done = set([file for entry in self.journal.units.values() for file in entry.get('files', [])]) if self.journal else set()
+                # a file has settled once its size and mtime are unchanged since the previous listing
+                files = sorted([file for file, stat in self.inventory.items() if file not in done and previous.get(file) == stat])
+                if files:
+                    self.logger.info("Watch found %r settled files for %s" % (len(files), self.section))
+                    sizes = {file: self.inventory[file][0] for file in files}
+                    if self.run_streams(files = files, journal = self.journal, streams = min(self.streams, len(files)), sizes = sizes): landed = len(files)
+                    else:
+                        self.logger.warning("Watch rsync failed for %s, retry on the next listing" % self.section)
+                        if self.metrics is not None: self.metrics.inc('retries_total', stage = self.cfg['stage'], section = self.section)
+        return landed
+
+    def set_inventories(self, sections=None, dir=None, stage=None, options=None):
+        # one remote command per host tests and lists every section, instead of a test -d and a find per section
+        self.inventories, hosts = ({}, OrderedDict())
+        if self.from_sas or not sections or not options: return
+        for section in sections:
+            sync = copy(self)
+            sync.section = section
+            sync.set_mjd_dir(env = options.get(section,'env_copy'), create = False)
+            sync.set_cfg(dir = dir, stage = stage, options = options)
+            if sync.ready and sync.cfg['ssh_config']: hosts.setdefault("{ssh_command} {ssh_config}".format(**sync.cfg), []).append(sync.cfg)
+        for ssh, cfgs in hosts.items(): self.inventories.update(self.get_inventories(ssh = ssh, cfgs = cfgs))
+
+    def get_inventories(self, ssh=None, cfgs=None):
+        # find -printf %P never starts a path with /, so the markers start with one and no file name can pass for a marker
+        script = ""
+        for cfg in cfgs:
+            mjd_dir, find_dir = ("{path}/{mjd}".format(**cfg), self.get_find_dir(cfg = cfg))
+            script += "if test -d %s; then echo '/#%s'; find %s -mindepth 1 -printf '%%P %%s %%T@ %%y\\n' || echo '/?'; else echo '/!%s'; fi; " % (mjd_dir, find_dir, find_dir, find_dir)
+        # the end marker tells a complete listing from a dropped connection
+        script += "echo '/'"
+        inventories, inventory, complete = ({}, None, False)
+        for line in self.process.lines('%s "%s"' % (ssh, script), ignore_error=True, timeout=self.watch_timeout):
+            # a /? after a listing marks a find that failed part way
+            if line == '/': complete = True
+            elif line.startswith('/#'): inventories[line[2:]] = inventory = []
+            elif line.startswith('/!'): inventories[line[2:]], inventory = (None, None)
+            elif inventory is not None: inventory.append(line)
+        if not complete:
+            self.logger.warning("Incomplete inventory from %s, test and list each section separately" % ssh)
+            return {}
+        self.logger.info("Inventory of %r sections from %s: %r found, %r files" % (len(cfgs), ssh, len([lines for lines in inventories.values() if lines is not None]), sum([len(lines) for lines in inventories.values() if lines])))
+        return inventories
+
+    def get_find_dir(self, cfg=None): return ("{path}/{mjd}/{folder}" if cfg['folder'] else "{path}/{mjd}").format(**cfg)
+
+    def set_inventory(self, maxdepth = 1, cached = False):
+        find_dir = self.get_find_dir(cfg = self.cfg) if not self.from_sas else None
+        if cached and find_dir in self.inventories:
+            # the prefetched inventory is recursive, so it stands in for any maxdepth
+            lines = self.inventories[find_dir]
+            if lines is None: self.inventory = self.listing = None
+            else: self.set_listing(lines = lines, status = 1 if '/?' in lines else 0)
+            return
+        if self.from_sas: command = "find {mjd_dir}"
+        else: command = "{ssh_command} {ssh_config} find {path}/{mjd}"
+        if self.cfg['folder']: command += "/{folder}"
+        printf = "'%P %s %T@ %y\\n'"
+        command = command.format(**self.cfg) + " -mindepth 1"
+        if maxdepth: command += " -maxdepth %r" % maxdepth
+        command += " -printf " + (printf if self.from_sas else '"%s"' % printf)
+        lines = self.process.lines(command, ignore_error=True, timeout=self.watch_timeout)
+        self.set_listing(lines = lines)
+
+    def set_listing(self, lines=None, status=None):
+        inventory, listing = ({}, OrderedDict())
+        for line in lines:
+            try:
+                file, size, mtime, type = line.rsplit(' ', 3)
+                size = int(size)
+            except ValueError: continue
+            if type == 'f': inventory[file] = (size, mtime)
+            # the top level entries, with the bytes of everything below them, are what the streams transfer
+            top = file.split('/', 1)[0]
+            listing[top] = listing.get(top, 0) + (size if type == 'f' else 0)
+        status = status if status is not None else self.process.status
+        # find exits 1 when part of the tree is unreadable, so keep what it listed and let rsync report the rest
+        self.partial = status != 0 and bool(listing)
+        if status != 0: self.logger.error("Listing of %s returned %r with %r entries listed" % (self.section, status, len(listing)))
+        self.inventory = inventory if status == 0 or self.partial else None
+        self.listing = OrderedDict(sorted(listing.items())) if status == 0 or self.partial else None
+
+    def get_partition(self, files=None, sizes=None, streams=None):
+        if not sizes: return [[files[index] for index in range(len(files)) if index % streams == stream_index] for stream_index in range(streams)]
+        # longest processing time first: each file goes to the stream with the fewest bytes so far
+        partition = [[] for stream_index in range(streams)]
+        heap = [(0, stream_index) for stream_index in range(streams)]
+        heapify(heap)
+        for file in sorted(files, key = lambda file: sizes.get(file, 0), reverse = True):
+            nbytes, stream_index = heap[0]
+            partition[stream_index].append(file)
+            heapreplace(heap, (nbytes + sizes.get(file, 0), stream_index))
+        nbytes = sorted([total for total, stream_index in heap])
+        self.logger.info("Partition %r files [%.2f GB] into %r streams [%.2f-%.2f GB]" % (len(files), sum(nbytes) / 1e9, streams, nbytes[0] / 1e9, nbytes[-1] / 1e9))
+        return [sorted(stream_files) for stream_files in partition]
+
+    def get_batches(self, files=None, sizes=None):
+        # the streams pull these in order as they free up, so the largest go first and the tail is small batches
+        batches, batch, nbytes = ([], [], 0)
+        sizes = sizes if sizes else {}
+        for file in sorted(files, key = lambda file: sizes.get(file, 0), reverse = True):
+            if batch and (len(batch) >= self.cfg['batch_files'] or nbytes + sizes.get(file, 0) > self.cfg['batch_bytes']):
+                batches.append(sorted(batch))
+                batch, nbytes = ([], 0)
+            batch.append(file)
+            nbytes += sizes.get(file, 0)
+        if batch: batches.append(sorted(batch))
+        self.logger.info("Queue %r files [%.2f GB] in %r batches for %r streams" % (len(files), sum([sizes.get(file, 0) for file in files]) / 1e9, len(batches), self.streams))
+        return batches
+
+    def run_streams(self, files=None, journal=None, streams=None, sizes=None):
+        streams, commands, units = (streams if streams else self.streams, [], [])
+        dynamic = self.cfg.get('dynamic')
+        labels = {'stage': self.cfg['stage'], 'section': self.section}
+        progress = Progress(section = self.section, total = sum([sizes.get(file, 0) for file in files]) if sizes else None, labels = labels, interval = self.cfg.get('progress_interval'), logger = self.logger, metrics = self.metrics, verbose = self.verbose) if self.cfg.get('progress') and not self.dryrun else None
+        partition = self.get_batches(files = files, sizes = sizes) if dynamic else self.get_partition(files = files, sizes = sizes, streams = streams)
+        for stream_index, stream_files in enumerate(partition):
+            if not stream_files: continue
+            self.cfg['stream_index'] = str(stream_index)
+            self.cfg['stream_filename'] = stream_filename = "{workdir}/{stage}.{section}.{stream_index}.rsync.txt".format(**self.cfg)
+            with open(stream_filename,'w') as stream_file: stream_file.write("\n".join(stream_files)+"\n")
+            command = "rsync {rsync_keywords} --files-from={stream_filename}"
+            if progress: command += " --info=progress2,stats2"
+            if self.from_sas: command += " {mjd_dir}/"
+            else: command += " {remote_path}/{mjd}/"
+            if self.cfg['folder']: command += "{folder}/"
+            if self.from_sas: command += " {remote_path}/{mjd}/"
+            else: command += " {mjd_dir}/"
+            if self.cfg['folder']: command += "{folder}/"
+            command = command.format(**self.cfg)
+            stream_log = stream_filename.replace('.txt','.log')
+            if self.dryrun: commands.append({'command':command ,'outfile':stream_log})
+            elif progress:
+                commands.append(Command(command=command, tail=self.process.tail, retries=self.retries if dynamic else 0, progress=True))
+                commands[-1].callback = progress.get_callback(command=commands[-1], file=open(stream_log,'w'))
+            else: commands.append(Command(command=command, outfile=open(stream_log,'w'), retries=self.retries if dynamic else 0))
+            units.append(stream_files)
+        if self.dryrun:
+            stream_file = "{workdir}/{stage}.{section}.rsync.json".format(**self.cfg)
+            with open(stream_file, 'w') as file: dump(commands, file, indent=4)
+            return True
+        else:
+            if self.tuner is not None and dynamic: self.run_tuned(commands = commands, units = units, sizes = sizes)
+            else: self.process.run_concurrent(commands=commands, limit=streams, budget=self.budget)
+            for stream, stream_files in zip(commands, units):
+                if journal and stream.status == 0 and stream_files: journal.record(unit = "rsync.%s" % md5("\n".join(stream_files).encode()).hexdigest(), files = stream_files)
+            for stream in commands:
+                try: stream.outfile.close()
+                except: pass
+            if progress:
+                progress.report(final = True)
+                progress.close()
+            if self.metrics is not None:
+                # a failed stream is retried or rerun, so only the files of the streams that exited cleanly count
+                self.metrics.inc('rsync_files_total', sum([len(stream_files) for stream, stream_files in zip(commands, units) if stream.status == 0]), stage = self.cfg['stage'], section = self.section)
+                self.metrics.inc('rsync_stream_failures_total', len([stream for stream in commands if stream.status != 0]), stage = self.cfg['stage'], section = self.section)
+            return all([stream.status == 0 for stream in commands])
+
+    def run_tuned(self, commands=None, units=None, sizes=None):
+        # one live queue over all batches, its limit follows the tuner as the throughput of each window responds
+        session = self.tuner.start(host = self.cfg['ssh_config'], logger = self.logger)
+        sizes, counted, owner = (sizes if sizes else {}, set(), self.tuner.is_owner(session = session, logger = self.logger))
+        self.set_streams(session = session)
+        tstart, retries = (time(), sum([stream.retries for stream in commands]))
+        try:
+            for running in self.process.execute(commands=commands, limit=lambda: session['streams'], budget=self.budget):
+                if time() - tstart < self.tuner.window: continue
+                # the other sections of the host follow the streams of the one section that probes
+                if self.tuner.is_owner(session = session, logger = self.logger):
+                    finished = [index for index, stream in enumerate(commands) if index not in counted and stream.done()]
+                    if owner and not finished: continue
+                    counted.update(finished)
+                    # the first window of a new owner, or the tail of the queue that cannot fill the slots, says nothing about the number of streams
+                    if owner and len(counted) + len(running) < len(commands):
+                        nbytes = sum([sum([sizes.get(file, 0) for file in units[index]]) for index in finished if commands[index].status == 0])
+                        failures = len([index for index in finished if commands[index].status != 0]) + retries - sum([stream.retries for stream in commands])
+                        self.tuner.record(session = session, nbytes = nbytes, seconds = time() - tstart, failures = failures)
+                    owner = True
+                else: owner = False
+                tstart, retries = (time(), sum([stream.retries for stream in commands]))
+                self.set_streams(session = session)
+        finally: self.tuner.stop(session = session)
+
+    def set_streams(self, session=None):
+        if self.metrics is not None: self.metrics.set('rsync_streams', session['streams'], stage = self.cfg['stage'], section = self.section)
+
+    def set_mjd_dir(self, env = None, create = True):
         if env:
             boss_section = env.startswith('BOSS') if env else None
             mjd_dir = join('boss',self.section) if boss_section else self.section
             mjd_dir = join(self.staging,mjd_dir,str(self.mjd))
             try:
-                self.process.mkdir(mjd_dir)
+                if create: self.process.mkdir(mjd_dir)
                 self.mjd_dir = mjd_dir
             except Exception as e:
                 self.mjd_dir = None
@@ -162,13 +382,27 @@ class Sync:
                 'rsync_keywords': self.rsync_keywords + ' --compress' if options.getboolean(self.section, 'compress') else self.rsync_keywords
             }
             self.cfg['folder'] = options.get(self.section,'folder') if options.has_option(self.section, 'folder') else None
+            self.cfg['dynamic'] = options.getboolean(self.section, 'dynamic', fallback = False)
+            self.cfg['batch_files'] = options.getint('general', 'batch_files', fallback = self.batch_files)
+            self.cfg['batch_bytes'] = options.getint('general', 'batch_bytes', fallback = self.batch_bytes)
+            self.cfg['progress'] = options.getboolean('general', 'progress', fallback = True)
+            self.cfg['progress_interval'] = options.getint('general', 'progress_interval', fallback = None)
             self.cfg['hostname'] = options.get(self.section,'hostname') if options.has_option(self.section, 'hostname') else "{machine}.{domain}".format(**self.cfg) if self.cfg['machine'] and self.cfg['domain'] else None
             self.cfg['ssh_config'] = options.get(self.section, ssh_config) if options.has_option(self.section, ssh_config) else "{user}@{hostname}".format(**self.cfg) if self.cfg['user'] and self.cfg['hostname'] else None
             self.cfg['remote_path'] = "{ssh_config}:{path}".format(**self.cfg) if self.cfg['ssh_config'] else None
             try:
-                self.cfg['ssh_command'] = 'ssh -p %r' % int(options.get(self.section,'port'))
-                self.cfg['rsync_keywords'] += ' --rsh="%(ssh_command)s"' % self.cfg
-            except: pass
+                self.cfg['port'] = int(options.get(self.section,'port'))
+                self.cfg['ssh_command'] = 'ssh -p %r' % self.cfg['port']
+            except: self.cfg['port'] = None
+            self.set_master()
+            if self.cfg['ssh_command'] != 'ssh': self.cfg['rsync_keywords'] += ' --rsh="%(ssh_command)s"' % self.cfg
+
+    def set_master(self):
+        if self.masters is not None and self.cfg['ssh_config'] and not self.from_sas:
+            # one ControlMaster per host, shared by every section, stream and MJD of the run
+            master = self.masters.setdefault((self.cfg['ssh_config'], self.cfg['port']), Master(host = self.cfg['ssh_config'], port = self.cfg['port'], logger = self.logger, verbose = self.verbose))
+            if master.start(): self.cfg['ssh_command'] += " " + master.get_options()
+            else: self.logger.warning("SYNC> No ControlMaster for %s, using separate ssh connections" % self.cfg['ssh_config'])
 
     def set_test(self):
         command = "" if self.from_sas else "{ssh_command} {ssh_config}"
@@ -177,8 +411,11 @@ class Sync:
         mjd_dir = "{mjd_dir}" if self.from_sas else "{path}/{mjd}"
         mjd_dir = mjd_dir.format(**self.cfg)
         command += mjd_dir
-        self.process.run(command)
-        self.test = True if self.process.status == 0 else False if self.process.status == 1 else None
+        find_dir = self.get_find_dir(cfg = self.cfg) if not self.from_sas else None
+        if find_dir in self.inventories: self.test = self.inventories[find_dir] is not None
+        else:
+            self.process.run(command)
+            self.test = True if self.process.status == 0 else False if self.process.status == 1 else None
         if self.test:
             self.logger.info("Data found in %s." % mjd_dir)
         elif self.test == False:
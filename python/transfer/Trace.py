@@ -0,0 +1,97 @@
+from os import walk
+from os.path import join, exists, isdir, basename
+from json import dumps, loads
+from threading import Lock
+from collections import OrderedDict
+
+class Trace:
+
+    ext = '.trace.jsonl'
+    keys = ['command', 'program', 'mjd']
+    ssh_options = ['-b', '-c', '-D', '-E', '-e', '-F', '-I', '-i', '-J', '-L', '-l', '-m', '-O', '-o', '-p', '-Q', '-R', '-S', '-W', '-w']
+
+    def __init__(self, file=None, verbose=False):
+        self.file = file
+        self.verbose = verbose
+        self.lock = Lock()
+        self.entries = []
+        if self.verbose and self.file: print("TRACE> file=%r" % self.file)
+
+    def append(self, entry=None):
+        if self.file and entry:
+            line = dumps(entry, separators=(',',':'))
+            with self.lock:
+                try:
+                    with open(self.file, 'a') as file: file.write(line + "\n")
+                except Exception as e:
+                    print("TRACE> %r" % e)
+                    self.file = None
+
+    def set_files(self, paths=None):
+        self.files = []
+        for path in paths if paths else []:
+            if isdir(path):
+                for root, dirs, files in walk(path):
+                    self.files += sorted([join(root, file) for file in files if file.endswith(self.ext)])
+            elif exists(path): self.files.append(path)
+            elif self.verbose: print("TRACE> Nonexistent %r" % path)
+        if self.verbose: print("TRACE> %r trace files" % len(self.files))
+
+    def set_entries(self, mjds=None):
+        self.entries = []
+        for path in self.files:
+            with open(path) as lines:
+                for line in lines:
+                    try:
+                        entry = loads(line)
+                        entry['mjd'] = int(entry['mjd']) if entry.get('mjd') else None
+                    except (ValueError, TypeError): continue
+                    if mjds and entry['mjd'] not in mjds: continue
+                    entry['file'] = path
+                    self.entries.append(entry)
+
+    def get_key(self, entry=None, key=None):
+        if key == 'command':
+            argv = entry['argv'] if entry and entry.get('argv') else ['?']
+            command = [basename(argv[0])]
+            if command[0] == 'ssh':
+                args, index = (argv[1:], 0)
+                while index < len(args) and args[index].startswith('-'): index += 2 if args[index] in self.ssh_options else 1
+                command += [basename(arg) for arg in args[index+1:index+2]]
+            elif command[0] == 'globus':
+                for arg in argv[1:3]:
+                    if arg.startswith('-') or ':' in arg or len(arg) == 36: break
+                    command.append(arg)
+            return " ".join(command)
+        else: return "%s" % entry.get(key)
+
+    def get_slowest(self, top=None):
+        return sorted(self.entries, key=lambda entry: entry.get('wall') or 0, reverse=True)[:top]
+
+    def get_ranking(self, key=None, top=None):
+        ranking = OrderedDict()
+        for entry in self.entries:
+            name = self.get_key(entry=entry, key=key if key in self.keys else self.keys[0])
+            rank = ranking.setdefault(name, {'name': name, 'count': 0, 'wall': 0.0, 'max': 0.0, 'user': 0.0, 'sys': 0.0, 'maxrss': 0, 'bytes': 0, 'failed': 0, 'mjds': set()})
+            wall = entry.get('wall') or 0.0
+            rank['count'] += 1
+            rank['wall'] += wall
+            rank['max'] = max(rank['max'], wall)
+            rank['user'] += entry.get('user') or 0.0
+            rank['sys'] += entry.get('sys') or 0.0
+            rank['maxrss'] = max(rank['maxrss'], entry.get('maxrss') or 0)
+            rank['bytes'] += sum((entry.get('bytes') or {}).values())
+            if entry.get('status'): rank['failed'] += 1
+            if entry.get('mjd'): rank['mjds'].add(entry['mjd'])
+        for rank in ranking.values(): rank['mean'] = rank['wall'] / rank['count'] if rank['count'] else 0.0
+        return sorted(ranking.values(), key=lambda rank: rank['wall'], reverse=True)[:top]
+
+    def print_ranking(self, key=None, top=None):
+        print("%-40s %7s %6s %12s %10s %10s %10s %10s %12s %8s" % (key if key else self.keys[0], 'count', 'mjds', 'wall[s]', 'mean[s]', 'max[s]', 'user[s]', 'sys[s]', 'output[B]', 'failed'))
+        for rank in self.get_ranking(key=key, top=top):
+            print("%-40s %7d %6d %12.1f %10.2f %10.2f %10.1f %10.1f %12d %8d" % (rank['name'][:40], rank['count'], len(rank['mjds']), rank['wall'], rank['mean'], rank['max'], rank['user'], rank['sys'], rank['bytes'], rank['failed']))
+
+    def print_slowest(self, top=None):
+        print("%10s %7s %10s %6s  %s" % ('wall[s]', 'mjd', 'maxrss[kB]', 'status', 'argv'))
+        for entry in self.get_slowest(top=top):
+            print("%10.2f %7s %10s %6s  %s" % (entry.get('wall') or 0.0, entry.get('mjd'), entry.get('maxrss'), entry.get('status'), " ".join(entry.get('argv') or [])[:160]))
@@ -1,14 +1,22 @@
-from transfer import Config, Process, Logging, Summary, Backup, Copy, Globus_process, Rclone, Report, Sync, Mirror
-from os import chdir, getcwd, listdir, environ, rmdir
-from os.path import join, exists, isdir, basename
-import re
-import gzip
+from transfer import Config, Process, Logging, Summary, Backup, Copy, Globus, Globus_process, Rclone, Report, Sync, Mirror, Trace, Lock, Journal, Plan, Scheduler, Metrics, Checksum, Cache, Reconcile, Tree, Tuner
+from os import listdir, environ, rmdir, walk, lstat
+from os.path import join, exists, isdir, basename, relpath
+from collections import OrderedDict
+from threading import Lock as ThreadLock, BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor
+from time import time, sleep
+from copy import copy
+from functools import partial
 
 class Transfer:
 
     drop_old_mjd_days = None
+    workers = 4
+    watch_interval = 300
+    stage_workers = {}
+    stage_after = {'download': [], 'verify': ['download'], 'copy': ['verify'], 'backup': ['verify'], 'mirror': ['copy']}
 
-    def __init__(self, options=None, observatory=None, mjd=None, ini_mode=None, log_dir=None, include=None, exclude=None, report=False, download=False, verify=False, backup=False, copy=False, mirror=False, sync=False, debug=False, verbose=False):
+    def __init__(self, options=None, observatory=None, mjd=None, ini_mode=None, log_dir=None, include=None, exclude=None, report=False, download=False, verify=False, backup=False, copy=False, mirror=False, sync=False, mjdlist=None, since=None, workers=None, restart=False, watch=None, plan=False, debug=False, verbose=False):
         self.observatory = options.observatory if options else observatory
         self.ini_mode = options.ini_mode if options else ini_mode
         self.log_dir = options.log_dir if options else log_dir
@@ -23,25 +31,84 @@ class Transfer:
         self.copy = options.copy if options else copy
         self.mirror = options.mirror if options else mirror
         self.sync = options.sync if options else sync
+        self.mjdlist = options.mjdlist if options else mjdlist
+        self.since = options.since if options else since
+        self.mjd_workers = options.workers if options else workers
+        self.batch = True if self.mjdlist or self.since else False
+        self.restart = options.restart if options else restart
+        self.watch = options.watch if options else watch
+        self.plan = options.plan if options else plan
         self.debug = options.debug if options else debug
         self.ready = False
         self.stage = None
+        self.handler = {}
+        self.summary_lock = ThreadLock()
+        self.histories = self.globus = self.metrics = self.cache = self.masters = self.tuner = None
+        self.plans = []
+        self.stage_metrics = {}
     
     def set_config(self):
         self.config = Config(observatory = self.observatory,  log_dir = self.log_dir, ini_mode = self.ini_mode, verbose = self.verbose)
-        if not self.mjd: self.mjd = self.config.current_mjd()
+        if not self.mjd and not self.batch: self.mjd = self.config.current_mjd()
+        self.metrics = Metrics(observatory = self.config.observatory, mode = self.config.mode, verbose = self.verbose)
+        # the rsync streams of every section, and of every MJD in a backfill, share one budget
+        self.budget = BoundedSemaphore(self.get_max_streams()) if self.config.options else None
+        self.set_tuner()
+        self.masters = {}
         if self.verbose: print("TRANSFER> MJD=%r" % self.mjd)
 
+    def get_max_streams(self):
+        options = self.config.options
+        streams = options.getint('general', 'streams', fallback = 1)
+        # the autotuner may go past the ini streams, up to max_streams
+        return options.getint('general', 'max_streams', fallback = 2 * streams) if options.getboolean('general', 'autotune', fallback = False) else streams
+
+    def set_tuner(self):
+        options = self.config.options
+        if options and options.getboolean('general', 'autotune', fallback = False):
+            dir = join(self.config.staging, self.config.log_dir) if self.config.staging and self.config.log_dir else None
+            self.tuner = Tuner(dir = dir, streams = options.getint('general', 'streams', fallback = 1), maximum = self.get_max_streams(), window = options.getint('general', 'autotune_window', fallback = None), verbose = self.verbose)
+
     def set_logging(self):  self.logging = Logging(staging = self.config.staging, observatory = self.config.observatory, log_dir = self.config.log_dir, mode = self.config.mode, mjd = self.mjd, debug = self.debug, verbose = self.verbose)
 
-    def set_process(self, program=None):  self.process = Process(program = program, mjd = self.mjd, logger = self.logging.logger, verbose = self.verbose)
+    def set_process(self, program=None):
+        self.trace = Trace(file = self.logging.trace_file, verbose = self.verbose)
+        self.process = Process(program = program, mjd = self.mjd, logger = self.logging.logger, trace = self.trace, locking = False, verbose = self.verbose)
 
     def set_sections(self):
-        self.sections = [section for section in self.config.options.sections() if section!='general']
-        if self.include: self.sections = [section for section in self.sections if section in self.include]
-        if self.exclude: self.sections = [section for section in self.sections if section not in self.exclude]
+        self.sections = self.get_sections()
+        self.set_locks()
         if self.verbose: print("TRANSFER> Sections=%r" % self.sections)
         self.ready = True if self.sections and self.logging.ready and self.process.ready else False
+
+    def get_sections(self):
+        sections = [section for section in self.config.options.sections() if section!='general']
+        if self.include: sections = [section for section in sections if section in self.include]
+        if self.exclude: sections = [section for section in sections if section not in self.exclude]
+        return sections
+
+    def set_locks(self):
+        self.locks, self.busy_sections = ({}, [])
+        for section in self.sections:
+            lock = Lock(observatory = self.config.observatory, mode = self.config.mode, mjd = self.mjd, section = section, verbose = self.verbose)
+            if lock.acquire(): self.locks[section] = lock
+            else:
+                self.busy_sections.append(section)
+                self.logging.logger.warning("Section %s for MJD=%r is in use by pid=%r [%s]" % (section, self.mjd, lock.pid, lock.holder))
+        self.sections = [section for section in self.sections if section in self.locks]
+
+    def get_journal(self, section=None, stage=None):
+        dir = join(self.logging.mjd_log_dir, 'journal') if self.logging.mjd_log_dir else None
+        return Journal(dir = dir, mjd = self.mjd, section = section, stage = stage, restart = self.restart, verbose = self.verbose)
+
+    def clear_journals(self, stage=None):
+        # a journal only resumes an interrupted run, so a later run of the MJD starts afresh
+        if self.logging.mjd_log_dir and not self.debug:
+            for section in self.sections + [None]: self.get_journal(section = section, stage = stage).clear()
+
+    def release_locks(self):
+        for lock in self.locks.values(): lock.release()
+        self.locks = {}
     
     def set_current_report(self):
         if self.report and self.ready:
@@ -53,157 +120,357 @@ class Transfer:
         else: self.current_report = None
 
     def set_summary(self, mode=None, status=None):
-        self.summary = Summary(staging = self.config.staging, observatory = self.config.observatory, log_dir=self.config.log_dir, mjd = self.mjd, logfile=self.current_report, verbose = self.verbose)
+        self.summary = Summary(staging = self.config.staging, observatory = self.config.observatory, log_dir=self.config.log_dir, mjd = self.mjd, logfile=self.current_report, histories = self.histories, verbose = self.verbose)
         if status: self.summary.todo_status = status
         for stage in self.summary.stages.keys(): self.summary.stages[stage] = getattr(self,stage)
         self.logging.logger.info("Ready to run stages [%s]" % ', '.join(self.summary.stages_todo()))
-        if not self.debug: self.summary.save(stage = self.stage)
+        if not self.debug:
+            with self.summary_lock: self.summary.save(stage = self.stage)
 
+    def set_batch(self):
+        self.set_shared_logging()
+        if self.logging.ready:
+            self.summary = Summary(staging = self.config.staging, observatory = self.config.observatory, log_dir = self.config.log_dir, verbose = self.verbose)
+            self.histories = self.summary.histories
+            self.set_mjds()
+            if (self.mirror or self.backup) and self.mjds and not self.plan: self.set_globus()
 
-    def run_verify(self):
-        if self.verify and self.ready:
-            self.stage = 'verify'
-            self.logging.set_stage(stage=self.stage)
-            logger = self.logging.logger
+    def set_shared_logging(self):
+        # the log of the whole run goes straight into log_dir, with no directory for an MJD
+        log_dir = join(self.config.staging, self.config.log_dir) if self.config.staging else None
+        self.logging = Logging(staging = self.config.staging, observatory = self.config.observatory, log_dir = self.config.log_dir, dir = log_dir, mode = self.config.mode, debug = self.debug, verbose = self.verbose)
+
+    def set_mjds(self):
+        todo = OrderedDict([(mjd, self.get_todo(history = history)) for mjd, history in self.histories.items()])
+        # an MJD without a status file never started, as after an outage, so it is todo from the first stage
+        mjds = self.mjdlist if self.mjdlist else range(self.since, self.config.current_mjd() + 1)
+        mjds = [mjd for mjd in mjds if mjd not in todo or todo[mjd] is not None]
+        # earliest unfinished stage first, so data leaves the observatory before it is mirrored, then oldest MJD first
+        self.mjds = sorted(set(mjds), key = lambda mjd: (todo.get(mjd) or 0, mjd))
+        self.logging.logger.info("Backfill MJDs [%s]" % ', '.join([str(mjd) for mjd in self.mjds]))
+        if self.verbose: print("TRANSFER> Backfill MJDs=%r" % self.mjds)
+
+    def get_todo(self, history=None):
+        stages = list(self.summary.stages)
+        todo = [stages.index(stage) for stage in stages if history.get(stage) and history[stage]['status'] in ('incomplete', 'failure')]
+        return min(todo) if todo else None
+
+    def set_globus(self):
+        self.globus = Globus(logger = self.logging.logger, metrics = self.metrics, verbose = self.verbose)
+        if not self.globus.ready:
+            self.logging.logger.critical("ERROR! Globus is not ready for the backfill")
+            self.globus = None
+
+    def run_mjds(self, program=None):
+        self.set_batch()
+        if self.logging.ready and self.mjds:
+            workers = self.mjd_workers if self.mjd_workers else self.config.options.getint('general', 'mjd_workers', fallback = 1)
+            with ThreadPoolExecutor(max_workers = workers) as executor:
+                for mjd, ready in zip(self.mjds, executor.map(lambda mjd: self.run_mjd(mjd = mjd, program = program), self.mjds)):
+                    (self.logging.logger.info if ready else self.logging.logger.error)("MJD=%r finished with ready=%r" % (mjd, ready))
+            if self.plan: self.print_plans()
+            self.stop_masters()
+            self.logging.logger.info("Done!")
+        elif not self.logging.ready: print("TRANSFER> Logging not ready!")
+
+    def run_mjd(self, mjd=None, program=None):
+        transfer = copy(self)
+        transfer.mjd, transfer.stage, transfer.ready, transfer.handler, transfer.stage_metrics = (mjd, None, False, {}, {})
+        if transfer.plan: return transfer.run_plan(program = program)
+        transfer.set_logging()
+        if transfer.logging.ready:
+            transfer.set_process(program = program)
+            transfer.set_sections()
+            if transfer.sections or not transfer.busy_sections:
+                transfer.set_current_report()
+                transfer.set_summary(mode = self.config.mode)
+                transfer.run_stages()
+                transfer.done()
+            else: transfer.logging.logger.critical("Detected another data transfer job running for MJD=%r and sections %s" % (mjd, ", ".join(transfer.busy_sections)))
+        return transfer.ready
+
+
+    def set_plan(self, program=None):
+        # a plan only reads, so it takes no locks, makes no run log directory and starts no ControlMaster
+        if not self.batch: self.set_shared_logging()
+        if self.logging.ready:
+            self.process = Process(program = program, mjd = self.mjd, logger = self.logging.logger, locking = False, verbose = self.verbose)
+            self.sections = self.get_sections()
+        self.ready = True if self.sections and self.logging.ready else False
+
+    def get_plan_journal(self, section=None, stage=None):
+        dir = join(self.config.staging, self.config.log_dir, str(self.mjd), 'journal') if self.config.staging and self.config.log_dir else None
+        return Journal(dir = dir if dir and exists(dir) else None, mjd = self.mjd, section = section, stage = stage, verbose = self.verbose)
+
+    def run_plan(self, program=None):
+        if self.plan: self.set_plan(program = program)
+        if self.plan and self.ready:
             options = self.config.options
+            histories = self.histories if self.histories is not None else Summary(staging = self.config.staging, observatory = self.config.observatory, log_dir = self.config.log_dir, verbose = self.verbose).histories
+            plan = Plan(staging = self.config.staging, mjd = self.mjd, histories = histories, stage_after = self.stage_after, verbose = self.verbose)
+            sync = Sync(staging=self.config.staging, mjd=self.mjd, streams=options.getint('general','streams'), process=self.process, logger=self.logging.logger, verbose=self.verbose)
+            copy_mjd = Copy(staging=self.config.staging, mjd=self.mjd, process=self.process, logger=self.logging.logger, verbose=self.verbose)
+            sync.set_inventories(sections = self.sections, stage = self.logging.get_stage(stage = 'plan'), options = options)
             for section in self.sections:
-                boss_section = section in ['sos', 'spectro'] if section else None
-                folder = join('boss',section) if boss_section else section
-                mjd_dir = join(self.config.staging,folder,str(self.mjd))
-                mjd_dir_nonempty = True if isdir(mjd_dir) and listdir(mjd_dir) else False
-                method = options.get(section,'verify')
-                if not self.debug:
-                    if method != 'SKIP' and mjd_dir_nonempty:
-                        sumfile = join(mjd_dir,'irsc.log.gz') if method == 'ircam' else join(mjd_dir,"{0:d}.{1}".format(self.mjd,method.split(' ')[0]))
-                        if self.verbose: print("TRANSFER> Verify %s using sumfile=%r" % (section, sumfile))
-                        if exists(sumfile):
-                            logger.info("{0} file exists, running {1} verification stage.".format(sumfile,section))
-                            if method == 'ircam':
-                                cRre = re.compile(r'(cR\d{6}\.fit)(\.gz|)\s*')
-                                with gzip.open(sumfile, "rt") as f: lines = f.read()
-                                ircamlog = dict()
-                                for l in lines.split('\n'):
-                                    if len(l) > 0:
-                                        m = cRre.match(l)
-                                        if m is None: continue
-                                        else:
-                                            k = m.groups()[0]
-                                            try:
-                                                ircamlog[k].append(l)
-                                            except KeyError:
-                                                ircamlog[k] = [ l ]
-                                sortedloglist = list(ircamlog.keys())
-                                sortedloglist.sort()
-                                sorteddisklist = list()
-                                for d in listdir(mjd_dir):
-                                    m = cRre.match(d)
-                                    if m is not None: sorteddisklist.append(m.groups()[0])
-                                sorteddisklist.sort()
-                                if len(sortedloglist) == len(sorteddisklist):
-                                    logger.info("Number of files in irsc.log equals number of files on disk (%r)" % len(sortedloglist))
-                                    for k in range(len(sorteddisklist)):
-                                        if sorteddisklist[k] != sortedloglist[k]:
-                                            logger.error("WARNING: file #{0}: {1} {2}!".format(k,sorteddisklist[k],sortedloglist[k]))
-                                            self.ready = False
-                                else:
-                                    if len(sortedloglist) > len(sorteddisklist):
-                                        logger.error("Number of files in irsc.log exceeds number of files on disk (%r>%r)" % (len(sortedloglist),len(sorteddisklist)))
-                                        for file in sortedloglist:
-                                            if file not in sorteddisklist: logger.error("    --> Missing %s on disk" % file)
-                                        for file in sorteddisklist:
-                                            if file not in sortedloglist: logger.error("    --> And missing %s in irsc.log" % file)
-                                    if len(sortedloglist) < len(sorteddisklist):
-                                        logger.error("Fewer files in irsc.log than the number of files on disk (%r<%r)" % (len(sortedloglist),len(sorteddisklist)))
-                                        for file in sorteddisklist:
-                                            if file not in sortedloglist: logger.error("    --> Missing %s in irsc.log" % file)
-                                        for file in sortedloglist:
-                                            if file not in sorteddisklist: logger.error("    --> And Missing %s on disk" % file)
-                                    self.ready = False
-
-                            else:
-                                oldwd = getcwd()
-                                chdir(mjd_dir)
-                                command = "{0} {1}".format(method,sumfile)
-                                self.process.run(command)
-                                for c in self.process.out.split("\n"):
-                                    if len(c) > 0:
-                                        l = c.rsplit(':',1)
-                                        try: foo = l[1].index('OK')
-                                        except ValueError:
-                                            logger.error("Checksum mismatch: {0}".format(l[0]))
-                                            self.ready = False
-                                chdir(oldwd)
-                        else:
-                            logger.error("{0} does not appear to exist!".format(sumfile))
-                            self.ready = False
-                    elif not mjd_dir_nonempty: logger.info("No {0} data found.".format(section))
-                if mjd_dir_nonempty:
-                    self.summary.export_section(directory=mjd_dir, section=section)
-                    logger.info("Export summary for section={0}.".format(section))
-
-            if not self.debug:
-                if self.ready: self.summary.save(stage=self.stage, status='success')
-                else:
-                    self.summary.save(stage=self.stage, status='failure')
-                    logger.critical("Errors verifying {0} data!".format(section))
+                env = options.get(section,'env_copy')
+                sync.section = section
+                sync.set_mjd_dir(env = env, create = False)
+                sync.set_cfg(stage = self.logging.get_stage(stage = 'plan'), options = options)
+                sync.set_inventory(maxdepth = None, cached = True)
+                local_dir = join(sync.mjd_dir, sync.cfg['folder']) if sync.mjd_dir and sync.cfg['folder'] else sync.mjd_dir
+                remote = {file: size for file, (size, mtime) in sync.inventory.items()} if sync.inventory else {}
+                local = plan.get_listing(dir = local_dir)
+                landed = dict(local)
+                landed.update(remote)
+                if sync.inventory is None: self.logging.logger.warning("No remote listing for section %s" % section)
+                if self.download: plan.add(section = section, stage = 'download', files = plan.get_changed(source = remote, destination = local))
+                if self.copy:
+                    destination = copy_mjd.get_destination(env = env, partition = options.get(section,'sas_copy'))
+                    copy_dir = join(destination, str(self.mjd), sync.cfg['folder']) if destination and sync.cfg['folder'] else join(destination, str(self.mjd)) if destination else None
+                    plan.add(section = section, stage = 'copy', files = plan.get_changed(source = landed, destination = plan.get_listing(dir = copy_dir)))
+                if self.mirror:
+                    try: mirror_dir = join(environ['TRANSFER_MIRROR_IPL_DIR'], relpath(environ[env], environ['SAS_BASE_DIR']), str(self.mjd))
+                    except KeyError: mirror_dir = None
+                    if mirror_dir and sync.cfg['folder']: mirror_dir = join(mirror_dir, sync.cfg['folder'])
+                    plan.add(section = section, stage = 'mirror', files = plan.get_changed(source = landed, destination = plan.get_listing(dir = mirror_dir)))
+                if self.backup:
+                    journal = self.get_plan_journal(section = section, stage = 'backup')
+                    for stage in ['tar', 'zstd', 'backup']:
+                        done = journal.done('tar' if stage == 'backup' else stage) and not plan.volume.get(section, {}).get('download', {}).get('files')
+                        plan.add(section = section, stage = stage, files = {} if done else landed)
+            self.plans.append(plan)
+            if not self.batch: plan.print()
+        return self.ready
 
-    def run_download(self):
-        if self.download and self.ready:
-            self.stage = 'download'
-            self.logging.set_stage(stage=self.stage)
-            logger = self.logging.logger
+    def print_plans(self):
+        for plan in sorted(self.plans, key = lambda plan: plan.mjd): plan.print()
+        total, seconds = ({}, 0)
+        for plan in self.plans:
+            for stage, volume in plan.get_total().items():
+                total[stage] = total.get(stage, 0) + volume['bytes']
+                seconds += volume['seconds'] if volume['seconds'] else 0
+        print("PLAN> %r MJDs: %s, estimate %.1f min" % (len(self.plans), ", ".join(["%s %.1f GB" % (stage, nbytes / 1e9) for stage, nbytes in total.items()]), seconds / 60))
+
+    def run_watch(self):
+        if self.watch and self.download and self.ready:
             options = self.config.options
-            streams = options.getint('general','streams')
-            perm = options.getboolean('general','permission')
-            sync = Sync(staging=self.config.staging, mjd=self.mjd, streams=streams, perm=perm, process=self.process, logger=logger, verbose=self.verbose)
-            if not sync.finalize:
-                for sync.section in self.sections:
-                    env = self.config.options.get(sync.section,'env_copy')
-                    sync.set_mjd_dir(env = env)
-                    sync.set_cfg(dir = self.logging.dir, stage = self.logging.stage, options = options)
-                    sync.set_test()
-                    if sync.test:
-                        if self.verbose: print("TRANSFER> Downloading section=%r" % sync.section)
-                    elif sync.test == False:
-                        if self.verbose: print("TRANSFER> Skipping nonexistent section=%r" % sync.section)
-                        continue
+            logger = self.logging.get_logger('watch')
+            interval = options.getint('general', 'watch_interval', fallback = self.watch_interval)
+            deadline = time() + self.watch * 3600
+            if self.set_download() is False: return
+            syncs = OrderedDict()
+            for section in [section for section in self.sections if options.getboolean(section, 'multiple')]:
+                syncs[section] = sync = copy(self.handler['download'])
+                sync.section, sync.logger = (section, logger)
+                sync.set_mjd_dir(env = options.get(section,'env_copy'))
+                sync.set_cfg(dir = self.logging.dir, stage = self.logging.get_stage(stage = 'watch'), options = options)
+                sync.journal = self.get_journal(section = section, stage = 'download')
+            logger.info("Watch sections [%s] every %rs for %r hours" % (', '.join(syncs), interval, self.watch))
+            while syncs and time() < deadline:
+                # only download during the night, copy waits for run_stages to verify the landed files against the sumfile
+                for sync in syncs.values(): sync.run_watch_rsync()
+                sleep(max(0, min(interval, deadline - time())))
+            # the journal now holds the landed files, which the nightly run must not discard
+            self.restart = False
+            logger.info("Watch done")
+
+    def run_stages(self):
+        if self.ready:
+            options = self.config.options
+            stages = [stage for stage in self.summary.stages if getattr(self, stage)]
+            workers = options.getint('general', 'workers', fallback=self.workers)
+            self.scheduler = Scheduler(workers = workers, logger = self.logging.get_logger(), metrics = self.metrics, verbose = self.verbose)
+            for stage in stages:
+                limit = options.getint('general', '%s_workers' % stage, fallback = self.stage_workers[stage] if stage in self.stage_workers else workers)
+                self.scheduler.add_stage(stage = stage, run = partial(self.run_section, stage), prepare = partial(self.prepare_stage, stage), finalize = getattr(self, "finalize_%s" % stage, None), on_done = self.set_stage_status, after = self.get_after(stage = stage, stages = stages), workers = limit)
+            self.scheduler.set_nodes(sections = self.sections)
+            self.scheduler.run()
+
+    def get_after(self, stage=None, stages=None):
+        after = []
+        for dependency in self.stage_after[stage]:
+            after += [dependency] if dependency in stages else self.get_after(stage = dependency, stages = stages)
+        return after
+
+    def run_stage(self, stage=None):
+        if getattr(self, stage) and self.ready:
+            status = {}
+            if self.prepare_stage(stage) is not False:
+                for section in self.sections: status[section] = 'success' if self.run_section(stage, section) else 'failure'
+                finalize = getattr(self, "finalize_%s" % stage, None)
+                if finalize and not finalize(status): status[None] = 'failure'
+            else: status[None] = 'failure'
+            self.set_stage_status(stage = stage, status = 'failure' if 'failure' in status.values() else 'success')
+
+    def prepare_stage(self, stage=None):
+        self.stage_metrics[stage] = {'tstart': time(), 'sections': OrderedDict(), 'globus': None}
+        return getattr(self, "set_%s" % stage)()
+
+    def run_section(self, stage=None, section=None):
+        tstart = time()
+        # only download and copy move the section's data within the section call, as the growth of their destination
+        dir = self.get_volume_dir(stage = stage, section = section)
+        before = self.get_volume(dir = dir) if dir else None
+        ready = getattr(self, "%s_section" % stage)(section)
+        files, nbytes = [after - before for after, before in zip(self.get_volume(dir = dir), before)] if dir else (None, None)
+        duration = time() - tstart
+        self.stage_metrics[stage]['sections'][section] = OrderedDict([('duration', round(duration, 1)), ('files', files), ('bytes', nbytes), ('rate', round(nbytes / duration / 1e6, 2) if duration and nbytes is not None else None)])
+        self.set_metrics(stage = stage, section = section, metrics = self.stage_metrics[stage]['sections'][section])
+        return ready
+
+    def get_volume_dir(self, stage=None, section=None):
+        if stage == 'download':
+            folder = join('boss',section) if section in ['sos', 'spectro'] else section
+            return join(self.config.staging, folder, str(self.mjd))
+        elif stage == 'copy':
+            destination = self.handler['copy'].get_destination(env = self.config.options.get(section,'env_copy'), partition = self.config.options.get(section,'sas_copy'))
+            return join(destination, str(self.mjd)) if destination else None
+        else: return None
+
+    def get_volume(self, dir=None):
+        files, nbytes = (0, 0)
+        for root, dirs, names in walk(dir):
+            for name in names:
+                try: nbytes += lstat(join(root, name)).st_size
+                except OSError: continue
+                files += 1
+        return (files, nbytes)
+
+    def get_metrics(self, stage=None):
+        metrics = self.stage_metrics.get(stage)
+        if metrics:
+            duration = time() - metrics['tstart']
+            sections = metrics['sections']
+            measured = [section for section in sections.values() if section['bytes'] is not None]
+            files, nbytes = (sum([section['files'] for section in measured]), sum([section['bytes'] for section in measured])) if measured else (None, None)
+            if metrics['globus']: files, nbytes = (metrics['globus']['files'], metrics['globus']['bytes'])
+            metrics = OrderedDict([('duration', round(duration, 1)), ('files', files), ('bytes', nbytes), ('rate', round(nbytes / duration / 1e6, 2) if duration and nbytes is not None else None), ('sections', sections)])
+        return metrics
+
+    def set_stage_status(self, stage=None, status=None):
+        if status == 'failure': self.ready = False
+        elif status == 'success': self.clear_journals(stage = stage)
+        # a debug run leaves only the verify status out of the summary
+        if not (self.debug and stage == 'verify'):
+            with self.summary_lock: self.summary.save(stage = stage, status = status, metrics = self.get_metrics(stage = stage))
+        if self.metrics is not None:
+            self.set_metrics(stage = stage, section = 'all', metrics = self.get_metrics(stage = stage))
+            self.metrics.set_state('stage_status', state = status, states = ['success', 'incomplete', 'failure'], stage = stage)
+            self.metrics.set('stage_timestamp_seconds', round(time(), 3), stage = stage)
+            self.metrics.set('last_mjd', self.mjd, stage = stage)
+
+    def set_metrics(self, stage=None, section=None, metrics=None):
+        if self.metrics is not None and metrics:
+            labels = {'stage': stage, 'section': section}
+            self.metrics.set('stage_files', metrics['files'], **labels)
+            self.metrics.set('stage_bytes', metrics['bytes'], **labels)
+            self.metrics.set('stage_duration_seconds', metrics['duration'], **labels)
+            if metrics['rate'] is not None: self.metrics.set('stage_rate_bytes_per_second', round(metrics['rate'] * 1e6), **labels)
+
+    def run_download(self): self.run_stage(stage = 'download')
+
+    def run_verify(self): self.run_stage(stage = 'verify')
+
+    def run_copy(self): self.run_stage(stage = 'copy')
+
+    def run_backup(self): self.run_stage(stage = 'backup')
+
+    def run_mirror(self): self.run_stage(stage = 'mirror')
+
+    def set_download(self):
+        options = self.config.options
+        streams = options.getint('general','streams')
+        perm = options.getboolean('general','permission')
+        self.handler['download'] = Sync(staging=self.config.staging, mjd=self.mjd, streams=streams, perm=perm, process=self.process, logger=self.logging.get_logger('download'), metrics=self.metrics, budget=self.budget, masters=self.masters, tuner=self.tuner, verbose=self.verbose)
+        self.handler['download'].set_inventories(sections = self.sections, dir = self.logging.dir, stage = self.logging.get_stage(stage = 'download'), options = options)
+        return not self.handler['download'].finalize
+
+    def download_section(self, section=None):
+        options = self.config.options
+        sync = copy(self.handler['download'])
+        logger = sync.logger
+        sync.section = section
+        env = options.get(section,'env_copy')
+        sync.set_mjd_dir(env = env)
+        sync.set_cfg(dir = self.logging.dir, stage = self.logging.get_stage(stage = 'download'), options = options)
+        if not sync.dryrun: sync.journal = self.get_journal(section = section, stage = 'download')
+        sync.set_test()
+        if sync.test:
+            if self.verbose: print("TRANSFER> Downloading section=%r" % section)
+        elif sync.test == False:
+            if self.verbose: print("TRANSFER> Skipping nonexistent section=%r" % section)
+            return True
+        else:
+            if self.verbose: print("TRANSFER> Critical error for section=%r" % section)
+            logger.critical("Error while testing for presence of {section}/{mjd}!".format(**sync.cfg))
+            return False
+        if options.getboolean(section,'multiple'): sync.run_multiple_rsync()
+        else: sync.run_single_rsync()
+        if not sync.ready: logger.critical("Error detected in rsync transfer of {path}".format(**sync.cfg))
+        return sync.ready
+
+    def set_verify(self):
+        self.handler['verify'] = self.logging.get_logger('verify')
+        self.cache = self.get_cache()
+
+    def get_cache(self): return Cache(dir = join(self.config.staging, self.config.log_dir) if self.config.staging and self.config.log_dir else None, verbose = self.verbose)
+
+    def verify_section(self, section=None):
+        logger = self.handler['verify']
+        options = self.config.options
+        ready = True
+        boss_section = section in ['sos', 'spectro'] if section else None
+        folder = join('boss',section) if boss_section else section
+        mjd_dir = join(self.config.staging,folder,str(self.mjd))
+        mjd_dir_nonempty = True if isdir(mjd_dir) and listdir(mjd_dir) else False
+        method = options.get(section,'verify')
+        if not self.debug:
+            if method != 'SKIP' and mjd_dir_nonempty:
+                reconcile = Reconcile(method = method, log = options.get(section, 'verify_log', fallback = None), pattern = options.get(section, 'verify_pattern', raw = True, fallback = None), mjd = self.mjd, logger = logger, verbose = self.verbose) if method == 'log' or method in Reconcile.presets else None
+                sumfile = join(mjd_dir, reconcile.log) if reconcile else join(mjd_dir,"{0:d}.{1}".format(self.mjd,method.split(' ')[0]))
+                if self.verbose: print("TRANSFER> Verify %s using sumfile=%r" % (section, sumfile))
+                if exists(sumfile):
+                    logger.info("{0} file exists, running {1} verification stage.".format(sumfile,section))
+                    if reconcile:
+                        if not reconcile.check(dir = mjd_dir): ready = False
                     else:
-                        self.summary.save(stage=self.stage, status='failure')
-                        if self.verbose: print("TRANSFER> Critical error for section=%r" % sync.section)
-                        logger.critical("Error while testing for presence of {section}/{mjd}!".format(**sync.cfg))
-                        self.ready = False
-                    if options.getboolean(sync.section,'multiple'): sync.run_multiple_rsync()
-                    else: sync.run_single_rsync()
-            if self.ready:
-                self.summary.save(stage=self.stage, status='success')
-            else:
-                self.summary.save(stage=self.stage, status='failure')
-                logger.critical("Error detected in rsync transfer of {path}".format(**sync.cfg))
+                        checksum = Checksum(method = method, manifest = options.get(section, 'manifest', fallback = None), workers = options.getint('general', 'verify_workers', fallback = None), cache = self.cache, logger = logger, verbose = self.verbose)
+                        checksum.check(sumfile = sumfile, dir = mjd_dir)
+                        if checksum.manifest: checksum.write_manifest(file = join(mjd_dir, "{0:d}.{1}".format(self.mjd, checksum.manifest)))
+                        for result in checksum.get_failures():
+                            if result['status'] == 'FAILED': logger.error("Checksum mismatch: {0}".format(result['file']))
+                            else: logger.error("Checksum {0}: {1} {2}".format(result['status'].lower(), result['file'], result['error']))
+                        if not checksum.ready or checksum.get_failures(): ready = False
+                else:
+                    logger.error("{0} does not appear to exist!".format(sumfile))
+                    ready = False
+            elif not mjd_dir_nonempty: logger.info("No {0} data found.".format(section))
+        if mjd_dir_nonempty:
+            self.summary.export_section(directory=mjd_dir, section=section)
+            logger.info("Export summary for section={0}.".format(section))
+        if not ready and not self.debug: logger.critical("Errors verifying {0} data!".format(section))
+        return ready
 
+    def set_copy(self):
+        resources_path = self.config.options.get('general','resources_path')
+        self.handler['copy'] = Copy(staging=self.config.staging, mjd=self.mjd, log_dir=self.config.log_dir, resources_path=resources_path, process=self.process, logger=self.logging.get_logger('copy'), verbose=self.verbose)
 
-    def run_copy(self):
-        if self.copy and self.ready:
-            self.stage = 'copy'
-            self.logging.set_stage(stage=self.stage)
-            resources_path = self.config.options.get('general','resources_path')
-            copy = Copy(staging=self.config.staging, mjd=self.mjd, log_dir=self.config.log_dir, resources_path=resources_path, process=self.process, logger=self.logging.logger, verbose=self.verbose)
-            done = None
-            for section in self.sections:
-                if copy.ready:
-                    env = self.config.options.get(section,'env_copy')
-                    partition = self.config.options.get(section,'sas_copy')
-                    env_links = self.config.options.get(section,'env_link').split('\n') if self.config.options.has_option(section,'env_link') else None
-                    copy.set_source(env=env, section=section)
-                    copy.set_destination(env=env, partition=partition)
-                    copy.copy_mjd()
-                    copy.drop_empty()
-                    copy.add_links(env_links=env_links)
-                    copy.drop_old_mjd(days = self.drop_old_mjd_days)
-                    if done is not False: done = True
-                else: done = False
-            copy.touch(done = done)
-            if self.ready: self.summary.save(stage=self.stage, status='success')
-            else: self.summary.save(stage=self.stage, status='failure')
+    def copy_section(self, section=None):
+        copy_mjd = copy(self.handler['copy'])
+        env = self.config.options.get(section,'env_copy')
+        partition = self.config.options.get(section,'sas_copy')
+        env_links = self.config.options.get(section,'env_link').split('\n') if self.config.options.has_option(section,'env_link') else None
+        copy_mjd.set_source(env=env, section=section)
+        copy_mjd.set_destination(env=env, partition=partition)
+        copy_mjd.copy_mjd()
+        copy_mjd.drop_empty()
+        copy_mjd.add_links(env_links=env_links)
+        copy_mjd.drop_old_mjd(days = self.drop_old_mjd_days)
+        return copy_mjd.ready
+
+    def finalize_copy(self, status=None):
+        self.handler['copy'].touch(done = all([value == 'success' for value in status.values()]))
+        return True
 
     def run_mirror_via_backup_to_tarball(self):
         if self.mirror and self.ready:
@@ -212,9 +479,7 @@ class Transfer:
             logger = self.logging.logger
             backup = Backup(staging=self.config.staging, observatory=self.config.observatory, mode = self.config.mode, mjd=self.mjd, process=self.process, dir=self.logging.dir, logger=logger, stage = self.stage, verbose=self.verbose)
             if backup.ready:
-                oldwd = getcwd()
                 for backup.section in self.sections: backup.tar()
-                chdir(oldwd)
                 #backup.set_globus_transfer()
                 #backup.globus_submit()
             else: self.ready = False
@@ -223,79 +488,104 @@ class Transfer:
             else:
                 logger.critical("ERROR! Remote is not ready for BACKUP")
                 self.summary.save(stage=self.stage, status='failure')
-                
-    def run_backup(self):
-        if self.backup and self.ready:
-            self.stage = 'backup'
-            message = None
-            self.logging.set_stage(stage=self.stage)
-            logger = self.logging.logger
-            backup = Backup(staging=self.config.staging, observatory=self.config.observatory, mode = self.config.mode, mjd=self.mjd, process=self.process, dir=self.logging.dir, logger=logger, verbose=self.verbose)
-            if backup.ready:
-                oldwd = getcwd()
-                for backup.section in self.sections:
-                    backup.tar()
-                    backup.copy_to_hpss_staging()
-                    backup.zstd_to_cloud_staging()
-                chdir(oldwd)
-            else:
-                self.ready = False
-                message = "ERROR! Transfer is not ready for BACKUP"
-            if self.ready:
-                mirror = Mirror(staging=self.config.staging, observatory=self.config.observatory, mode=self.config.mode, mjd=self.mjd, process=self.process, log_dir=self.logging.dir, logger=logger, save_manifest=True, verbose=self.verbose)
-                mirror.stage = mirror.stage.replace("mirror", "backup")
-                mirror.set_options(verify = True, preserve_mtime = True, fail_on_quota_errors = True)
-                if mirror.ready:
-                    staging_ext = {'hpss':'.tar', 'cloud': '.tar.zstd'}
-                    for mirror.section in self.sections:
-                        observatory = "lvm" if mirror.section.startswith("lvm") else self.config.observatory
-                        for staging, ext in staging_ext.items():
-                            tranfer_staging = 'transfer/%s/staging' % staging
-                            location = join(observatory, mirror.section)
-                            mirror.location = join(tranfer_staging, location, "%s_%s%s" % (self.mjd, mirror.section, ext))
-                            mirror.set_scratch()
-                            mirror.set_base_dir()
-                            mirror.append_item(staging = staging)
-                    mirror.execute_transfer()
-                    if mirror.transfer: mirror.wait()
-                    else:
-                        self.ready = False
-                        message = "ERROR! Globus is not ready for BACKUP to MIRROR"
-            if self.ready: self.summary.save(stage=self.stage, status='success')
-            else:
-                logger.critical(message)
-                self.summary.save(stage=self.stage, status='failure')
 
-    def run_mirror(self):
-        if self.mirror and self.ready:
-            self.stage = 'mirror'
-            self.logging.set_stage(stage=self.stage)
-            logger = self.logging.logger
-            mirror = Mirror(staging=self.config.staging, observatory=self.config.observatory, mode=self.config.mode, mjd=self.mjd, process=self.process, log_dir=self.logging.dir, logger=logger, save_manifest=True, verbose=self.verbose)
-            message = None
-            if mirror.ready:
-                for mirror.section in self.sections:
-                    mirror.env = self.config.options.get(mirror.section,'env_copy')
-                    mirror.set_location_from_env()
-                    mirror.append_item()
-                    mirror.set_manifest()
-                mirror.execute_transfer()
-                if mirror.transfer:
-                    mirror.wait()
-                    mirror.write_task_file()
-                else:
-                    message = "ERROR! Globus failure to TRANSFER"
-                    self.ready = False
-                mirror.done()
-            else:
-                message = "ERROR! Globus is not ready for MIRROR"
-                self.ready = False
+    def set_backup(self):
+        logger = self.logging.get_logger('backup')
+        self.handler['backup'] = Backup(staging=self.config.staging, observatory=self.config.observatory, mode = self.config.mode, mjd=self.mjd, process=self.process, dir=self.logging.dir, logger=logger, metrics=self.metrics, verbose=self.verbose)
+        if not self.handler['backup'].ready: logger.critical("ERROR! Transfer is not ready for BACKUP")
+        return self.handler['backup'].ready
 
-            if self.ready: self.summary.save(stage=self.stage, status='success')
-            else:
-                if message: logger.critical(message)
-                self.summary.save(stage=self.stage, status='failure')
+    def backup_section(self, section=None):
+        backup = copy(self.handler['backup'])
+        backup.section = section
+        backup.journal = self.get_journal(section = section, stage = 'backup')
+        backup.tar()
+        if backup.ready and section in backup.tarfiles:
+            backup.copy_to_hpss_staging()
+            backup.zstd_to_cloud_staging()
+        return True
+
+    def finalize_backup(self, status=None):
+        if 'success' not in status.values(): return False
+        logger = self.logging.get_logger('backup')
+        message = None
+        mirror = Mirror(staging=self.config.staging, observatory=self.config.observatory, mode=self.config.mode, mjd=self.mjd, process=self.process, log_dir=self.logging.dir, logger=logger, save_manifest=True, globus=self.globus, metrics=self.metrics, verbose=self.verbose)
+        mirror.stage = mirror.stage.replace("mirror", "backup")
+        mirror.set_options(verify = True, preserve_mtime = True, fail_on_quota_errors = True)
+        if mirror.ready:
+            staging_ext = {'hpss':'.tar', 'cloud': '.tar.zstd'}
+            for mirror.section in [section for section in self.sections if status.get(section) == 'success']:
+                observatory = "lvm" if mirror.section.startswith("lvm") else self.config.observatory
+                for staging, ext in staging_ext.items():
+                    tranfer_staging = 'transfer/%s/staging' % staging
+                    location = join(observatory, mirror.section)
+                    mirror.location = join(tranfer_staging, location, "%s_%s%s" % (self.mjd, mirror.section, ext))
+                    mirror.set_scratch()
+                    mirror.set_base_dir()
+                    mirror.append_item(staging = staging)
+            self.execute_mirror(mirror = mirror, stage = 'backup')
+            if not mirror.transfer: message = "ERROR! Globus is not ready for BACKUP to MIRROR"
+        else: message = "ERROR! Globus is not ready for BACKUP to MIRROR"
+        if message: logger.critical(message)
+        return message is None
 
+    def set_mirror(self):
+        logger = self.logging.get_logger('mirror')
+        self.handler['mirror'] = mirror = Mirror(staging=self.config.staging, observatory=self.config.observatory, mode=self.config.mode, mjd=self.mjd, process=self.process, log_dir=self.logging.dir, logger=logger, save_manifest=True, globus=self.globus, metrics=self.metrics, verbose=self.verbose)
+        if mirror.ready: mirror.item, mirror.identical = (OrderedDict(), [])
+        else: logger.critical("ERROR! Globus is not ready for MIRROR")
+        return mirror.ready
+
+    def mirror_section(self, section=None):
+        mirror = copy(self.handler['mirror'])
+        mirror.section = section
+        mirror.env = self.config.options.get(section,'env_copy')
+        mirror.set_location_from_env()
+        if self.is_mirrored(mirror = mirror): mirror.identical.append(section)
+        else:
+            mirror.append_item()
+            mirror.set_manifest()
+        return True
+
+    def is_mirrored(self, mirror=None):
+        method = self.config.options.get('general', 'mirror_compare', fallback = None)
+        if not method or not mirror.base_dir or not mirror.location: return False
+        if self.cache is None and method != 'stat': self.cache = self.get_cache()
+        source, destination = [join(mirror.base_dir[key], mirror.location, str(self.mjd)) for key in ('source', 'destination')]
+        # the destination is the path on the Globus endpoint, which only a host that mounts the mirror can read
+        if not isdir(mirror.base_dir['destination']):
+            mirror.logger.info("Mirror %s is not mounted here, so the %s comparison is skipped" % (mirror.base_dir['destination'], method))
+            return False
+        tree = Tree(method = method, cache = self.cache, workers = self.config.options.getint('general', 'verify_workers', fallback = None), logger = mirror.logger, verbose = self.verbose)
+        tree.compare(source = source, destination = destination)
+        missing = tree.get_missing()
+        for status, path in missing[:20]: mirror.logger.info("Mirror %s %s" % (status, join(destination, path)))
+        if tree.ready and not missing: mirror.logger.info("Mirror destination %s matches the source [skip]" % destination)
+        return tree.ready and not missing
+
+    def finalize_mirror(self, status=None):
+        mirror = self.handler['mirror']
+        if not mirror.item:
+            if mirror.identical: mirror.logger.info("Mirror destinations match for sections [%s], no Globus task needed" % ", ".join(mirror.identical))
+            return len(mirror.identical) > 0
+        self.execute_mirror(mirror = mirror, stage = 'mirror')
+        if mirror.transfer: mirror.write_task_file()
+        else: mirror.critical_message("ERROR! Globus failure to TRANSFER")
+        mirror.done()
+        return mirror.transfer is not None
+
+    def execute_mirror(self, mirror=None, stage=None):
+        journal = self.get_journal(stage = stage)
+        items = list(mirror.item) if mirror.item else []
+        entry = journal.get('globus', items = items)
+        if entry: mirror.resume_transfer(task_id = entry.get('task_id'))
+        if not mirror.transfer:
+            mirror.execute_transfer()
+            if mirror.transfer: journal.record(unit = 'globus', task_id = mirror.globus.task_id, items = items)
+        if mirror.transfer:
+            mirror.wait()
+            task = getattr(mirror, 'task', None) or {}
+            if stage in self.stage_metrics: self.stage_metrics[stage]['globus'] = {'files': task.get('files_transferred', 0), 'bytes': task.get('bytes_transferred', 0)}
 
     def run_mirror0(self):
         logger = self.logging.logger
@@ -403,7 +693,14 @@ class Transfer:
                 self.summary.save(stage=self.stage, status='failure')
 
 
+    def stop_masters(self):
+        if self.masters:
+            for master in self.masters.values(): master.stop()
+            self.masters.clear()
+
     def done(self):
+        self.release_locks()
+        if not self.batch: self.stop_masters()
         self.logging.set_stage()
         self.logging.logger.info("Done!")
 
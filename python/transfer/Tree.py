@@ -0,0 +1,93 @@
+from os import scandir, readlink
+from os.path import join, isdir
+from hashlib import blake2b
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from transfer.Checksum import Checksum
+
+class Tree:
+
+    method = 'stat'
+
+    def __init__(self, method=None, cache=None, workers=None, logger=None, verbose=False):
+        self.method = method if method else self.method
+        self.logger = logger
+        self.verbose = verbose
+        self.checksum = Checksum(method = self.method, workers = workers, cache = cache, logger = logger, verbose = verbose) if self.method != 'stat' else None
+        self.ready = self.checksum.ready if self.checksum else True
+        self.differences = []
+
+    def build(self, dir=None):
+        files = []
+        root = self.get_node(path = dir, files = files) if dir and isdir(dir) else None
+        if root and self.checksum and files:
+            with ThreadPoolExecutor(max_workers = self.checksum.workers) as executor:
+                for node, digest in zip(files, executor.map(self.get_digest, files)): node['digest'] = digest
+            if self.checksum.cache is not None: self.checksum.cache.commit()
+        if root: self.set_hash(node = root)
+        return root
+
+    def get_node(self, path=None, files=None):
+        node = {'type': 'dir', 'children': OrderedDict(), 'hash': None}
+        with scandir(path) as entries:
+            for entry in sorted(entries, key = lambda entry: entry.name):
+                if entry.is_symlink(): node['children'][entry.name] = {'type': 'link', 'target': readlink(entry.path), 'hash': None}
+                elif entry.is_dir(): node['children'][entry.name] = self.get_node(path = entry.path, files = files)
+                else:
+                    stat = entry.stat()
+                    node['children'][entry.name] = child = {'type': 'file', 'path': entry.path, 'size': stat.st_size, 'mtime': int(stat.st_mtime), 'digest': None, 'hash': None}
+                    files.append(child)
+        return node
+
+    def get_digest(self, node=None):
+        try: return self.checksum.digest(path = node['path'])[0][self.checksum.algorithm]
+        except OSError as e:
+            self.error_message("Cannot hash %r: %r" % (node['path'], e))
+            return None
+
+    def set_hash(self, node=None):
+        if node['type'] == 'dir':
+            # a directory hash covers the names and hashes of everything below it
+            hash = blake2b(digest_size = 16)
+            for name, child in node['children'].items(): hash.update(("%s\0%s\0%s\n" % (name, child['type'], self.set_hash(node = child))).encode(errors = 'surrogateescape'))
+            node['hash'] = hash.hexdigest()
+        elif node['type'] == 'link': node['hash'] = node['target']
+        elif self.checksum and node['digest'] is None: node['hash'] = "unreadable:%s" % node['path']
+        else: node['hash'] = "%s:%s" % (node['size'], node['digest'] if self.checksum else node['mtime'])
+        return node['hash']
+
+    def compare(self, source=None, destination=None):
+        self.differences = []
+        if self.ready:
+            with ThreadPoolExecutor(max_workers = 2) as executor: trees = list(executor.map(self.build, [source, destination]))
+            if trees[0] is None: self.differences.append(('missing source', ''))
+            elif trees[1] is None: self.differences.append(('missing', ''))
+            else: self.diff(source = trees[0], destination = trees[1])
+            self.info_message("%s %s vs %s: %s" % (self.method, source, destination, "identical" if self.is_identical() else "%r differences" % len(self.differences)))
+        return self.differences
+
+    def diff(self, source=None, destination=None, path=''):
+        if source['hash'] == destination['hash']: return
+        if source['type'] == destination['type'] == 'dir':
+            # descend only into the subtrees whose hashes differ
+            for name, child in source['children'].items():
+                location = join(path, name)
+                if name not in destination['children']: self.differences.append(('missing', location))
+                else: self.diff(source = child, destination = destination['children'][name], path = location)
+            for name in destination['children']:
+                if name not in source['children']: self.differences.append(('extra', join(path, name)))
+        else: self.differences.append(('changed', path))
+
+    def is_identical(self): return self.ready and not self.differences
+
+    def get_missing(self): return [difference for difference in self.differences if difference[0] != 'extra']
+
+    def info_message(self, message=None):
+        if message:
+            if self.logger: self.logger.info(message)
+            if self.verbose: print("TREE> %s" % message)
+
+    def error_message(self, message=None):
+        if message:
+            if self.logger: self.logger.error(message)
+            if self.verbose: print("TREE> %s" % message)
@@ -0,0 +1,101 @@
+from os import environ, replace, getpid
+from os.path import join, exists
+from json import load, dump
+from fcntl import flock, LOCK_EX
+from time import time
+from threading import Lock, get_ident
+
+class Tuner:
+
+    name = '.streams.json'
+    gain = 0.1
+    window = 60
+
+    def __init__(self, dir=None, file=None, streams=None, maximum=None, window=None, logger=None, verbose=False):
+        self.streams = streams if streams else 1
+        self.window = window if window else self.window
+        self.maximum = maximum if maximum else 2 * self.streams
+        self.logger = logger
+        self.verbose = verbose
+        self.lock = Lock()
+        self.sessions = {}
+        self.set_file(dir = dir, file = file)
+        self.set_hosts()
+
+    def set_file(self, dir=None, file=None):
+        self.file = file if file else environ.get('TRANSFER_TUNER_FILE') or (join(dir, self.name) if dir else None)
+        if self.verbose: print("TUNER> file=%r" % self.file)
+
+    def set_hosts(self):
+        self.hosts = self.get_hosts()
+
+    def get_hosts(self):
+        hosts = {}
+        if self.file and exists(self.file):
+            try:
+                with open(self.file) as file: hosts = load(file)
+            except Exception as e: print("TUNER> %r" % e)
+        return hosts
+
+    def start(self, host=None, logger=None):
+        # sections of one host run at once and share its link, so they share one session and only its owner probes
+        with self.lock:
+            session = self.sessions.get(host) if host else None
+            if session is None:
+                # last night's optimum for the host is the starting point, else ramp up from half the ini streams
+                streams = self.hosts.get(host, {}).get('streams') if host else None
+                streams = min(self.maximum, max(1, streams if streams else self.streams // 2))
+                session = {'host': host, 'streams': streams, 'best': streams, 'rate': None, 'settled': False, 'logger': logger, 'owner': None, 'users': 0}
+                if host: self.sessions[host] = session
+            session['users'] += 1
+        return session
+
+    def is_owner(self, session=None, logger=None):
+        with self.lock:
+            if session['owner'] is None: session['owner'], session['logger'] = (get_ident(), logger if logger else session['logger'])
+            return session['owner'] == get_ident()
+
+    def stop(self, session=None):
+        with self.lock:
+            session['users'] -= 1
+            if session['owner'] == get_ident(): session['owner'] = None
+            done = not session['users']
+            if done and self.sessions.get(session['host']) is session: del self.sessions[session['host']]
+        if done: self.save(session = session)
+
+    def record(self, session=None, nbytes=None, seconds=None, failures=0):
+        rate = nbytes / seconds if seconds else 0
+        message = "%s %r streams: %.1f MB/s over %.0f s" % (session['host'], session['streams'], rate / 1e6, seconds if seconds else 0)
+        if failures:
+            # errors mean the link or the remote end is saturated, so back off and stay there
+            session['streams'], session['best'], session['settled'] = (max(1, session['streams'] - 1), max(1, session['streams'] - 1), True)
+            message += ", %r failed, back off to %r" % (failures, session['streams'])
+        elif session['rate'] is None or rate > session['rate'] * (1 + self.gain):
+            session['best'], session['rate'] = (session['streams'], rate)
+            if not session['settled'] and session['streams'] < self.maximum:
+                session['streams'] += 1
+                message += ", try %r" % session['streams']
+        elif not session['settled']:
+            session['streams'], session['settled'] = (session['best'], True)
+            message += ", diminishing returns, settle on %r" % session['streams']
+        self.info_message(message, logger = session['logger'])
+        return session['streams']
+
+    def save(self, session=None):
+        if self.file and session and session['host'] and session['rate']:
+            temp = "%s.%r.tmp" % (self.file, getpid())
+            try:
+                # other processes tune other hosts into the same file, so merge this host into it under a lock
+                with self.lock, open(self.file + '.lock', 'w') as lock:
+                    flock(lock, LOCK_EX)
+                    self.hosts = self.get_hosts()
+                    self.hosts[session['host']] = {'streams': session['best'], 'rate': round(session['rate']), 'timestamp': round(time(), 3)}
+                    with open(temp, 'w') as file: dump(self.hosts, file, indent=2)
+                    replace(temp, self.file)
+            except Exception as e: print("TUNER> %r" % e)
+
+    def info_message(self, message=None, logger=None):
+        logger = logger if logger else self.logger
+        if message:
+            if logger: logger.info(message)
+            if self.verbose: print("TUNER> %s" % message)
@@ -0,0 +1,104 @@
+from os import environ, listdir, makedirs, getcwd, unlink, cpu_count
+from os.path import join, exists, isdir
+from json import dump
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from transfer.Checksum import Checksum
+from transfer.Cache import Cache
+
+class Verify:
+
+    method = 'md5sum'
+    manifests = ['xxh128sum', 'b3sum', 'b2sum']
+    workers = 4
+    perm = 0o775
+
+    def __init__(self, dir=None, env=None, outdir=None, method=None, fast=False, workers=None, threads=None, force=False, verbose=False):
+        self.method = method if method else self.method
+        self.fast = fast
+        self.workers = workers if workers else self.workers
+        # bound the hashing threads across all MJDs verified at once
+        self.threads = threads if threads else max(1, min(32, (cpu_count() or 1) * 2) // self.workers)
+        self.force = force
+        self.verbose = verbose
+        self.report = OrderedDict()
+        self.set_dir(dir = dir, env = env)
+        self.set_outdir(outdir = outdir)
+        self.cache = Cache(verbose = self.verbose) if self.dir else None
+
+    def set_dir(self, dir=None, env=None):
+        self.dir = dir if dir else environ.get(env) if env else None
+        if self.dir and not isdir(self.dir):
+            print("VERIFY> Nonexistent %r" % self.dir)
+            self.dir = None
+        if self.verbose: print("VERIFY> dir=%r" % self.dir)
+
+    def set_outdir(self, outdir=None):
+        self.outdir = outdir if outdir else getcwd()
+        try:
+            if not exists(self.outdir): makedirs(self.outdir, self.perm)
+        except Exception as e:
+            print("VERIFY> %r" % e)
+            self.outdir = None
+        if self.verbose: print("VERIFY> outdir=%r" % self.outdir)
+
+    def set_mjds(self, mjds=None, range=False):
+        if mjds and range and len(mjds) == 2: mjds = [mjd for mjd in self.get_mjds() if mjds[0] <= mjd <= mjds[1]]
+        self.mjds = sorted(set(mjds)) if mjds else self.get_mjds()
+        if self.verbose: print("VERIFY> %r MJDs" % len(self.mjds))
+
+    def get_mjds(self): return sorted([int(name) for name in listdir(self.dir) if name.isdigit() and isdir(join(self.dir, name))]) if self.dir else []
+
+    def run(self):
+        self.ready = self.dir is not None and self.outdir is not None
+        if self.ready:
+            tstart = time()
+            with ThreadPoolExecutor(max_workers = self.workers) as executor:
+                for mjd, result in zip(self.mjds, executor.map(lambda mjd: self.verify_mjd(mjd = mjd), self.mjds)):
+                    self.report[mjd] = result
+                    if self.verbose or result['status'] != 'OK': print("VERIFY> %r %s" % (mjd, result['status']))
+            self.seconds = time() - tstart
+
+    def get_sumfile(self, mjd=None):
+        mjd_dir = join(self.dir, str(mjd))
+        methods = (self.manifests if self.fast else []) + [self.method]
+        for method in methods:
+            sumfile = join(mjd_dir, "%s.%s" % (mjd, method))
+            if exists(sumfile) and (method == self.method or Checksum(method = method).ready): return method, sumfile
+        return self.method, None
+
+    def verify_mjd(self, mjd=None):
+        result = OrderedDict([('status', None), ('method', None), ('sumfile', None), ('files', 0), ('bytes', 0), ('seconds', None), ('failures', [])])
+        method, result['sumfile'] = self.get_sumfile(mjd = mjd)
+        result['method'] = method
+        outfile = join(self.outdir, "%s.%s.o" % (mjd, self.method))
+        errfile = join(self.outdir, "%s.%s.e" % (mjd, self.method))
+        if exists(outfile) and not self.force: result['status'] = 'SKIP'
+        elif not result['sumfile']: result['status'] = 'NOSUMFILE'
+        else:
+            checksum = Checksum(method = method, workers = self.threads, cache = self.cache)
+            checksum.check(sumfile = result['sumfile'], dir = join(self.dir, str(mjd)))
+            failures = checksum.get_failures()
+            result['status'] = 'OK' if checksum.ready and checksum.ok else 'FAILED'
+            result['files'], result['bytes'], result['seconds'] = (len(checksum.results), checksum.nbytes, round(checksum.seconds, 1)) if checksum.ready else (0, 0, None)
+            result['failures'] = [OrderedDict([('file', failure['file']), ('status', failure['status']), ('error', failure['error'])]) for failure in failures]
+            count = {'match': len(checksum.results) - len(failures), 'mismatch': len(failures)}
+            lines = ["Checksum mismatch: %s" % failure['file'] if failure['status'] == 'FAILED' else "Checksum %s: %s %s" % (failure['status'].lower(), failure['file'], failure['error']) for failure in failures]
+            lines.append("VERIFY> %r OK." % mjd if result['status'] == 'OK' else "VERIFY> MJD %r Found %r -> FAILED, %r --> MATCHED" % (mjd, count['mismatch'], count['match']))
+            with open(outfile, 'w') as file: file.write("\n".join(lines) + "\n")
+            if result['status'] == 'OK':
+                if exists(errfile): unlink(errfile)
+            else:
+                with open(errfile, 'w') as file: file.write("\n".join(lines) + "\n")
+        return result
+
+    def write_report(self, file=None):
+        file = file if file else join(self.outdir, "verify.%s-%s.json" % (self.mjds[0], self.mjds[-1])) if self.outdir and self.mjds else None
+        if file:
+            count = OrderedDict()
+            for result in self.report.values(): count[result['status']] = count.get(result['status'], 0) + 1
+            report = OrderedDict([('dir', self.dir), ('method', self.method), ('seconds', round(self.seconds, 1)), ('count', count), ('bytes', sum([result['bytes'] for result in self.report.values()])), ('mjds', OrderedDict([(str(mjd), result) for mjd, result in self.report.items()]))])
+            with open(file, 'w') as output: dump(report, output, indent=2)
+            print("VERIFY> %r MJDs [%s] in %.1fs, report %r" % (len(self.report), ", ".join(["%s=%r" % item for item in count.items()]), self.seconds, file))
+        return file
@@ -1,10 +1,23 @@
 from .Argument import Argument
 from .Config import Config
 from .Logging import Logging
+from .Lock import Lock
 from .Process import Process
+from .Trace import Trace
+from .Metrics import Metrics
+from .Journal import Journal
+from .Cache import Cache
+from .Checksum import Checksum
+from .Reconcile import Reconcile
+from .Verify import Verify
+from .Tree import Tree
+from .Tuner import Tuner
+from .Progress import Progress
+from .Plan import Plan
 from .Summary import Summary
 from .Report import Report
 from .Remote import Remote
+from .Master import Master
 from .Globus import Globus
 from .Globus_process import Globus_process
 from .Rclone import Rclone
@@ -12,5 +25,6 @@ from .Backup import Backup
 from .Mirror import Mirror
 from .Copy import Copy
 from .Sync import Sync
+from .Scheduler import Scheduler
 from .Transfer import Transfer
 from .GitHub import GitHub